@@ -2,6 +2,7 @@ import base64
 import hashlib
 import json
 import ecdsa
+from key_cache import parsed_keys
 
 
 def hash(str):
@@ -18,11 +19,11 @@ def stringify_key(key):
 
 
 def obtain_key_from_string(key_string):
-    return ecdsa.VerifyingKey.from_string(base64.decodebytes(key_string.encode('ascii')))
+    return parsed_keys.get(base64.decodebytes(key_string.encode('ascii')))
 
 
 def verify_sig(sig, msg, pubkey):
-    ecdsa_pubkey = ecdsa.VerifyingKey.from_string(bytes.fromhex(pubkey))
+    ecdsa_pubkey = parsed_keys.get(bytes.fromhex(pubkey))
     return ecdsa_pubkey.verify(bytes.fromhex(sig), msg.encode())
 
 
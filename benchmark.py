@@ -0,0 +1,230 @@
+"""
+Micro-benchmarks for the SUTDCoin building blocks.
+Run `python benchmark.py` for every benchmark or `python benchmark.py <name> ...` for a subset.
+"""
+import random
+import sys
+import tempfile
+import time
+from ecdsa import SigningKey
+import blockchain
+from blockchain import Blockchain
+from block import Block
+from transaction import Transaction
+from miner import Miner
+from pow_engine import header_parts, search_range
+from signature_verifier import SignatureVerifier, verify_chunk
+from signature_cache import verified_signatures
+from algorithms import *
+
+
+def easy_target():
+    """Drop the difficulty so that benchmarks measure bookkeeping instead of hashing"""
+    blockchain.TARGET = "f" * 64
+
+
+def extend_chain(chain, count, miner_public, transactions=list):
+    """Append `count` blocks to the tip of `chain`"""
+    for _ in range(count):
+        block = Block(transactions(), time.time(), chain.last_node.block.hash, miner_public)
+        proof = chain.proof_of_work(block)
+        chain.add(block, proof)
+
+
+def offline_miner(chain):
+    """A Miner that is not registered on the network, enough for its validation methods"""
+    miner = Miner.__new__(Miner)
+    miner.blockchain = chain
+    miner.log_prefix = "Benchmark miner: "
+    return miner
+
+
+def bench_block_index(sizes=(1000, 10000, 100000), sample=1000):
+    """Average cost of inserting a block once the chain has reached each size"""
+    easy_target()
+    miner_public = SigningKey.generate().get_verifying_key()
+    chain = Blockchain()
+    print("blocks in chain | usec per insert")
+    for size in sizes:
+        extend_chain(chain, size - chain.length, miner_public)
+        start = time.perf_counter()
+        extend_chain(chain, sample, miner_public)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>15} | {elapsed / sample * 1e6:.1f}")
+
+
+def bench_nonce_validation(chain_length=10000, block_txs=1000, accounts=100):
+    """Validate a block with block_txs transactions on top of a chain_length block chain"""
+    easy_target()
+    keys = [SigningKey.generate() for _ in range(accounts)]
+    publics = [key.get_verifying_key() for key in keys]
+    nonces = [0] * accounts
+    chain = Blockchain()
+    for height in range(chain_length):
+        transactions = []
+        if height >= accounts and height % 10 == 0:
+            sender = height % accounts
+            tx = Transaction.new(publics[sender], publics[(sender + 1) % accounts], 1, "", keys[sender], nonces[sender])
+            transactions.append(tx.serialize())
+            nonces[sender] += 1
+        extend_chain(chain, 1, publics[height % accounts], lambda: transactions)
+
+    transactions = []
+    for i in range(block_txs):
+        sender = i % accounts
+        tx = Transaction.new(publics[sender], publics[(sender + 1) % accounts], 1, "", keys[sender], nonces[sender])
+        transactions.append(tx.serialize())
+        nonces[sender] += 1
+
+    tip_hash = chain.last_node.block.hash
+    start = time.perf_counter()
+    for public in publics:
+        chain.get_nonce(stringify_key(public), tip_hash)
+    lookup = time.perf_counter() - start
+
+    miner = offline_miner(chain)
+    start = time.perf_counter()
+    valid = miner.check_balance_and_nonce(transactions, tip_hash)
+    elapsed = time.perf_counter() - start
+    print(f"chain of {chain_length} blocks, block of {block_txs} transactions, valid = {valid}")
+    print(f"nonce lookup: {lookup / accounts * 1e6:.1f} usec")
+    print(f"check_balance_and_nonce: {elapsed:.3f} s")
+
+
+def bench_store_reopen(chain_length=20000):
+    """Reopen a persisted chain and query it, against building the same chain in memory"""
+    easy_target()
+    miner_public = SigningKey.generate().get_verifying_key()
+    directory = tempfile.mkdtemp()
+    chain = Blockchain.open(directory)
+    start = time.perf_counter()
+    extend_chain(chain, chain_length, miner_public)
+    build = time.perf_counter() - start
+    chain.store.close()
+
+    start = time.perf_counter()
+    reopened = Blockchain.open(directory)
+    reopen = time.perf_counter() - start
+    start = time.perf_counter()
+    reopened.get_account_balance(stringify_key(miner_public))
+    first_query = time.perf_counter() - start
+    print(f"{chain_length} blocks: built in {build:.2f} s, reopened in {reopen:.3f} s, "
+          f"first balance query {first_query:.2f} s")
+
+
+def bench_reorg(sizes=(1000, 10000), depths=(1, 10)):
+    """Time for the best chain to switch to a fork of the given depth (ties go to the newest tip)"""
+    easy_target()
+    miner_public = SigningKey.generate().get_verifying_key()
+    print("blocks in chain | reorg depth | msec per reorg")
+    for size in sizes:
+        chain = Blockchain()
+        extend_chain(chain, size, miner_public)
+        for depth in depths:
+            view = chain.fork(chain.get_block_at_height(chain.length - depth).hash)
+            extend_chain(view, depth, miner_public)
+            blocks = view.get_blks()[depth - 1::-1]
+            for block in blocks[:-1]:
+                chain.add(block, block.hash)
+            chain.get_balance()
+            start = time.perf_counter()
+            chain.add(blocks[-1], blocks[-1].hash)
+            chain.get_balance()
+            elapsed = time.perf_counter() - start
+            print(f"{size:>15} | {depth:>11} | {elapsed * 1e3:.2f}")
+
+
+def bench_pow_hash_rate(hashes=200000):
+    """Hashes per second of the old random-nonce loop against the prefix-hashing engine loop"""
+    block = Block([], time.time(), "0" * 64, None)
+    start = time.perf_counter()
+    for _ in range(hashes):
+        random.seed(time.time())
+        block.nonce = random.randint(0, 100000000)
+        block.compute_hash() < blockchain.TARGET
+    old = hashes / (time.perf_counter() - start)
+
+    prefix, suffix = header_parts(block)
+    start = time.perf_counter()
+    search_range(prefix, suffix, 0, 0, hashes, lambda: False)  # no hash is below 0
+    new = hashes / (time.perf_counter() - start)
+    print(f"random nonce + json.dumps per attempt: {old:,.0f} hashes/s")
+    print(f"hashed header prefix + sequential nonces: {new:,.0f} hashes/s ({new / old:.1f}x)")
+
+
+def bench_batch_verify(batch=256, workers=(1, 4, 16)):
+    """Signatures verified per second one by one against batches spread over worker processes"""
+    keys = [SigningKey.generate() for _ in range(10)]
+    receiver = keys[0].get_verifying_key()
+    tx_jsons = [Transaction.new(keys[i % 10].get_verifying_key(), receiver, 1, "", keys[i % 10], i).serialize()
+                for i in range(batch)]
+    start = time.perf_counter()
+    verify_chunk(tx_jsons)
+    print(f"inline: {batch / (time.perf_counter() - start):,.0f} signatures/s")
+    for count in workers:
+        verifier = SignatureVerifier(count, min_pool_batch=1)
+        verifier.verify_batch(tx_jsons[:count])  # start the worker processes
+        verified_signatures.clear()
+        start = time.perf_counter()
+        verifier.verify_batch(tx_jsons)
+        elapsed = time.perf_counter() - start
+        verifier.close()
+        print(f"{count} workers: {batch / elapsed:,.0f} signatures/s")
+
+
+def bench_wire_format(block_txs=1000, rounds=5):
+    """
+    Bytes per transaction and encode/decode throughput of the JSON and binary block formats.
+    Both decoders give a Block with its transaction JSON and Merkle tree; transaction fields are
+    decoded lazily by both, so the decode is also timed with every sender and amount read.
+    """
+    keys = [SigningKey.generate() for _ in range(10)]
+    tx_jsons = [Transaction.new(keys[i % 10].get_verifying_key(), keys[(i + 1) % 10].get_verifying_key(),
+                                random.randint(1, 100), "", keys[i % 10], i).serialize()
+                for i in range(block_txs)]
+    block = Block(tx_jsons, time.time(), "0" * 64, keys[0].get_verifying_key())
+    block.hash = block.header_hash
+
+    def read_fields(decoded):
+        for tx_json in decoded.transactions:
+            tx = Transaction.deserialize(tx_json, verify=False)
+            tx.sender, tx.amount
+
+    formats = {
+        "json": (lambda: block.serialize().encode(), lambda data: Block.deserialize(data.decode())),
+        "binary": (block.to_bytes, Block.from_bytes),
+    }
+    for name, (encode, decode) in formats.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            data = encode()
+        encode_rate = rounds * block_txs / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decoded = decode(data)
+        decode_rate = rounds * block_txs / (time.perf_counter() - start)
+        assert decoded.serialize() == block.serialize()
+        start = time.perf_counter()
+        for _ in range(rounds):
+            read_fields(decode(data))
+        fields_rate = rounds * block_txs / (time.perf_counter() - start)
+        print(f"{name}: {len(data) / block_txs:.1f} bytes/tx, encode {encode_rate:,.0f} tx/s, "
+              f"decode {decode_rate:,.0f} tx/s, decode and read fields {fields_rate:,.0f} tx/s")
+
+
+BENCHMARKS = {
+    "block_index": bench_block_index,
+    "nonce_validation": bench_nonce_validation,
+    "store_reopen": bench_store_reopen,
+    "reorg": bench_reorg,
+    "pow_hash_rate": bench_pow_hash_rate,
+    "batch_verify": bench_batch_verify,
+    "wire_format": bench_wire_format,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"===== {name}")
+        BENCHMARKS[name]()
@@ -3,21 +3,61 @@ from merkle_tree import *
 from transaction import *
 from hashlib import sha256
 from algorithms import *
+from key_cache import parsed_keys
 import json
 import random
+import struct
+
+# Binary encoding: version, flags, previous hash, Merkle root, block hash, timestamp, nonce,
+# height, miner key and transaction count, followed by each binary transaction behind its length.
+# The flags tell which optional fields are present and whether the timestamp is an integer, so
+# that the JSON header, and with it the block hash, is rebuilt exactly.
+BLOCK_FORMAT_VERSION = 1
+BLOCK_HEADER = struct.Struct(">BB32s32s32sdQI48sI")
+TX_LENGTH = struct.Struct(">H")
+FLAG_ROOT = 1
+FLAG_HASH = 2
+FLAG_MINER = 4
+FLAG_INT_TIMESTAMP = 8
+FLAG_NO_PREVIOUS = 16  # the genesis block, its previous hash is "0"
+
+
+class HeaderField:
+    """A Block attribute that is part of the header. Setting it drops the cached header hash."""
+
+    def __set_name__(self, owner, name):
+        self.attr = "_" + name
+
+    def __get__(self, block, owner=None):
+        if block is None:
+            return self
+        return getattr(block, self.attr)
+
+    def __set__(self, block, value):
+        setattr(block, self.attr, value)
+        block._header_hash = None
 
 
 class Block:
-    def __init__(self, transactions, timestamp,previous_hash, miner):
+    previous_hash = HeaderField()
+    root = HeaderField()
+    timestamp = HeaderField()
+    nonce = HeaderField()
+
+    def __init__(self, transactions, timestamp,previous_hash, miner, merkle=None):
         """
         Constructor for the `Block` class.
         :param transactions:  List of transactions.
         :param timestamp:     Time of generation of the block.
         :param previous_hash: Hash of the previous block in the chain which this block is part of.
+        :param merkle:        MerkleTree already built over transactions, if any.
         :PARAMS not included in intiliazation is hash
         """
+        self._header_hash = None
         self.miner = miner
-        self.merkle = MerkleTree(transactions) if len(transactions) != 0 else None
+        if merkle is None and len(transactions) != 0:
+            merkle = MerkleTree(transactions)
+        self.merkle = merkle
         self.transactions = transactions
         if self.merkle is None:
             self.root = None
@@ -29,6 +69,10 @@ class Block:
         self.blk_height = 0
         self.hash = ""
 
+    def txids(self):
+        """Transaction ids in block order, read from the Merkle leaves without hashing again"""
+        return [leaf.hash for leaf in self.merkle.leaves] if self.merkle is not None else []
+
     @property
     def header(self):
         return {
@@ -61,18 +105,86 @@ class Block:
         block.blk_height = deserialized['blk_height']
         return block
 
+    def to_bytes(self):
+        # Compact binary encoding, raises ValueError for blocks or transactions it cannot hold
+        # (see Transaction.to_bytes), Block.serialize() stays available for those and for debugging
+        flags = 0
+        if self.root is not None:
+            flags |= FLAG_ROOT
+        if self.hash:
+            flags |= FLAG_HASH
+        if self.miner is not None:
+            flags |= FLAG_MINER
+        if type(self.timestamp) is int:
+            flags |= FLAG_INT_TIMESTAMP
+        if self.previous_hash == "0":
+            flags |= FLAG_NO_PREVIOUS
+        miner = self.miner.to_string() if self.miner is not None else b""
+        if len(miner) not in (0, KEY_SIZE):
+            raise ValueError("binary format only holds NIST192p keys")
+        try:
+            header = BLOCK_HEADER.pack(
+                BLOCK_FORMAT_VERSION, flags,
+                bytes.fromhex(self.previous_hash) if self.previous_hash != "0" else b"",
+                bytes.fromhex(self.root) if self.root is not None else b"",
+                bytes.fromhex(self.hash), self.timestamp, self.nonce, self.blk_height, miner,
+                len(self.transactions))
+        except struct.error as e:
+            raise ValueError(e)
+        parts = [header]
+        for tx_json in self.transactions:
+            tx = Transaction.deserialize(tx_json, verify=False)
+            if not tx.is_canonical():
+                # the JSON rebuilt from the bytes would hash to another txid and Merkle root
+                raise ValueError("binary format only holds transactions in canonical JSON")
+            data = tx.to_bytes()
+            parts.append(TX_LENGTH.pack(len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        # Instantiates a block from to_bytes() output
+        if len(data) < BLOCK_HEADER.size or data[0] != BLOCK_FORMAT_VERSION:
+            raise ValueError("not a version %d binary block" % BLOCK_FORMAT_VERSION)
+        _, flags, previous_hash, root, blk_hash, timestamp, nonce, blk_height, miner, count = \
+            BLOCK_HEADER.unpack_from(data)
+        transactions = []
+        offset = BLOCK_HEADER.size
+        for _ in range(count):
+            length, = TX_LENGTH.unpack_from(data, offset)
+            offset += TX_LENGTH.size
+            transactions.append(Transaction.from_bytes(data[offset:offset + length]).serialize())
+            offset += length
+        if offset != len(data):
+            raise ValueError("binary block has the wrong length")
+        block = Block(transactions, int(timestamp) if flags & FLAG_INT_TIMESTAMP else timestamp,
+                      "0" if flags & FLAG_NO_PREVIOUS else previous_hash.hex(),
+                      parsed_keys.get(miner) if flags & FLAG_MINER else None)
+        if (block.root is not None) != bool(flags & FLAG_ROOT) or (block.root is not None and block.root != root.hex()):
+            raise ValueError("binary block does not match its Merkle root")
+        block.nonce = nonce
+        block.hash = blk_hash.hex() if flags & FLAG_HASH else ""
+        block.blk_height = blk_height
+        return block
 
     def compute_hash(self):
         """
         Returns the hash of the block instance by first converting it
-        into JSON string.
+        into JSON string. The result is cached until a header field changes.
         """
+        if self._header_hash is None:
+            block_string = json.dumps(self.header)  # The string equivalent also considers the previous_hash field now
+            self._header_hash = sha256(block_string.encode()).hexdigest()
+        return self._header_hash
 
-        block_string = json.dumps(self.header)  # The string equivalent also considers the previous_hash field now
-        return sha256(block_string.encode()).hexdigest()
+    @property
+    def header_hash(self):
+        """Cached hash of the header, cheap enough for lookups and logging"""
+        return self.compute_hash()
 
     def __str__(self):
-        return "hash: {}, number of transactions: {}".format(self.compute_hash(),len(self.transactions)) if not self.blk_height == 0 else "root"
+        return "hash: {}, number of transactions: {}".format(self.header_hash,len(self.transactions)) if not self.blk_height == 0 else "root"
 
     def __eq__(self, other):
         return self.nonce == other.nonce and self.root == other.root and self.timestamp == other.timestamp and self.previous_hash == other.previous_hash
@@ -0,0 +1,99 @@
+import mmap
+import os
+import struct
+from block import Block
+
+'''
+Append-only on-disk block store.
+blocks.dat holds length-prefixed serialized blocks, one after the other. Blocks are written in the
+binary format of Block.to_bytes(), or as JSON for the few it cannot encode; JSON bodies start
+with "{", so both (and stores written before the binary format) are read back.
+index.dat holds one fixed-size record per block (hash, previous hash, offset, length, height),
+so the block tree can be rebuilt from the index alone and bodies are read through mmap on demand.
+A crash can leave a torn index record or segment bytes that no record points to; both are cut off
+when the store is opened, before anything new is appended after them.
+'''
+
+INDEX_RECORD = struct.Struct(">32s32sQII")
+LENGTH_PREFIX = struct.Struct(">I")
+
+
+class IndexRecord:
+    def __init__(self, blk_hash, prev_hash, offset, length, height):
+        self.hash = blk_hash
+        self.prev_hash = prev_hash
+        self.offset = offset
+        self.length = length
+        self.height = height
+
+
+class BlockStore:
+    SEGMENT_FILE = "blocks.dat"
+    INDEX_FILE = "index.dat"
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_path = os.path.join(directory, BlockStore.SEGMENT_FILE)
+        self.index_path = os.path.join(directory, BlockStore.INDEX_FILE)
+        self.repair()
+        self.segment = open(self.segment_path, "ab")
+        self.index = open(self.index_path, "ab")
+        self.segment_map = None
+
+    def repair(self):
+        """Truncate the index to whole records and the segment to the end of the last indexed block"""
+        if not os.path.exists(self.index_path):
+            return
+        index_size = os.path.getsize(self.index_path)
+        whole = index_size - index_size % INDEX_RECORD.size
+        if whole != index_size:
+            os.truncate(self.index_path, whole)
+        records = self.records()
+        segment_end = records[-1].offset + records[-1].length if records else 0
+        if os.path.exists(self.segment_path) and os.path.getsize(self.segment_path) > segment_end:
+            os.truncate(self.segment_path, segment_end)
+
+    def append(self, block):
+        """Persist a block that has just been added to the chain"""
+        try:
+            data = block.to_bytes()
+        except ValueError:
+            data = block.serialize().encode()
+        offset = self.segment.tell() + LENGTH_PREFIX.size
+        self.segment.write(LENGTH_PREFIX.pack(len(data)))
+        self.segment.write(data)
+        self.segment.flush()
+        # the index record goes last, a crash in between only leaves unreferenced bytes in the segment
+        self.index.write(INDEX_RECORD.pack(bytes.fromhex(block.hash), bytes.fromhex(block.previous_hash),
+                                           offset, len(data), block.blk_height))
+        self.index.flush()
+
+    def records(self):
+        """All index records in insertion order, parents always come before their children"""
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        records = []
+        # a torn record at the end of the file is ignored
+        for i in range(len(data) // INDEX_RECORD.size):
+            blk_hash, prev_hash, offset, length, height = INDEX_RECORD.unpack_from(data, i * INDEX_RECORD.size)
+            records.append(IndexRecord(blk_hash.hex(), prev_hash.hex(), offset, length, height))
+        return records
+
+    def read_block(self, offset, length):
+        if self.segment_map is None or offset + length > len(self.segment_map):
+            # the segment has grown since it was last mapped
+            if self.segment_map is not None:
+                self.segment_map.close()
+            with open(self.segment_path, "rb") as f:
+                self.segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.segment_map[offset:offset + length]
+        if data[:1] == b"{":
+            return Block.deserialize(data.decode())
+        return Block.from_bytes(data)
+
+    def close(self):
+        if self.segment_map is not None:
+            self.segment_map.close()
+        self.segment.close()
+        self.index.close()
@@ -0,0 +1,124 @@
+import time
+from block import Block
+from merkle_tree import MerkleTree
+
+'''
+Block template kept by a miner between mining attempts.
+The template holds the mempool transactions that are valid on top of the best tip, checked with
+the same rules as Miner.check_balance_and_nonce. A new transaction is checked against the running
+balances and appended to the Merkle tree along a single path; the template is only rebuilt from
+the mempool when the tip moves. A sender's transactions are only taken in an unbroken run of nonces
+from the last one on the chain: the first missing nonce holds back all the later ones, until the
+transaction filling the gap arrives. Mining takes a block built from the template without any setup.
+When the mempool expires or evicts a transaction the template holds, the template is emptied and
+rebuilt from the mempool on the next take(), so it never holds more than the mempool does.
+'''
+
+
+class BlockTemplate:
+    def __init__(self, blockchain, miner_key, mempool=None):
+        self.blockchain = blockchain
+        self.miner_key = miner_key
+        # the chain's lock: tip listeners reset the template holding it, and checking a
+        # transaction queries the chain, so a lock of its own could be taken in either order
+        self.lock = blockchain.lock
+        self.reset(mempool)
+
+    def reset(self, mempool):
+        """Rebuild the template on the current best tip from the mempool"""
+        with self.lock:
+            self.mempool = mempool
+            self.stale = False  # set when the mempool dropped one of the transactions, see drop()
+            self.txids = set()
+            tip = self.blockchain.last_node.block
+            self.previous_hash = tip.hash
+            self.balances = None  # balances at the tip, read on the first transaction (see load_balances)
+            self.next_nonces = {}  # sender -> nonce its next transaction must carry, filled on demand
+            self.transactions = []
+            self.merkle = None
+            self.shared = False  # the Merkle tree belongs to a block handed out by take()
+            if mempool is None:
+                return
+            for sender, entries in mempool.sender_queues():
+                if sender in self.load_balances():
+                    self.include_ready(sender, entries)
+
+    def add(self, entry):
+        """Add a new mempool entry if it is valid on top of the template, returns whether it was"""
+        with self.lock:
+            if self.stale:
+                return False  # the rebuild in take() picks it up from the mempool
+            if not self.include(entry):
+                return False
+            if self.mempool is not None:
+                # entry may fill a gap, the later transactions of its sender are ready now
+                self.include_ready(entry.sender, self.mempool.sender_entries(entry.sender))
+            return True
+
+    def drop(self, entries):
+        """Mempool entries that were expired or evicted, see Mempool.add_drop_listener"""
+        with self.lock:
+            if self.stale or not any(entry.txid in self.txids for entry in entries):
+                return
+            # later transactions may depend on the dropped ones, the template is rebuilt on take()
+            self.stale = True
+            self.transactions = []
+            self.merkle = None
+            self.txids = set()
+
+    def next_nonce(self, sender):
+        """Nonce of the next transaction of sender, following the chain and the template"""
+        if sender not in self.next_nonces:
+            self.next_nonces[sender] = self.blockchain.get_nonce(sender, self.previous_hash) + 1
+        return self.next_nonces[sender]
+
+    def include_ready(self, sender, entries):
+        """Include the entries of sender, given in nonce order, up to the first missing nonce"""
+        for entry in entries:
+            # nonces the chain or the template have already passed can never be applied
+            if entry.nonce < self.next_nonce(sender):
+                continue
+            if not self.include(entry):
+                break
+
+    def load_balances(self):
+        """
+        Balances on the chain the template builds on. They are only read once a transaction is
+        checked, so that an empty template does not replay a chain reopened from the block store
+        """
+        if self.balances is None:
+            self.balances = self.blockchain.get_balance(self.previous_hash)
+        return self.balances
+
+    def include(self, entry):
+        sender, receiver, amount, nonce = entry.sender, entry.receiver, entry.amount, entry.nonce
+        if sender not in self.load_balances():
+            return False
+        if nonce != self.next_nonce(sender):
+            return False
+        changed = {sender: self.balances[sender] - amount}
+        changed[receiver] = changed.get(receiver, self.balances.get(receiver, 0)) + amount
+        if min(changed.values()) < 0:
+            return False
+
+        self.next_nonces[sender] = nonce + 1
+        self.balances.update(changed)
+        self.transactions.append(entry.tx_json)
+        self.txids.add(entry.txid)
+        if self.merkle is None:
+            self.merkle = MerkleTree.from_hashes([entry.txid])
+        else:
+            if self.shared:
+                # copy on write, the block being mined keeps the tree it was built with
+                self.merkle = self.merkle.copy()
+                self.shared = False
+            self.merkle.append_hash(entry.txid)
+        return True
+
+    def take(self):
+        """A new block with the template transactions on top of the tip the template was built on"""
+        with self.lock:
+            if self.stale:
+                self.reset(self.mempool)
+            self.shared = self.merkle is not None
+            return Block(list(self.transactions), time.time(), self.previous_hash, self.miner_key, self.merkle)
@@ -5,48 +5,166 @@ from block import Block
 from transaction import Transaction
 from merkle_tree import *
 from algorithms import *
+from chain_state import StateEngine
+from block_store import BlockStore
 import copy
+import functools
+import threading
 TARGET = "00000fffffffffff"
 
 class Node:
-    def __init__(self, previous, block=Block):
-        self.block = block
+    def __init__(self, previous, block=Block, loader=None):
+        self._block = block
+        self.loader = loader  # reads the block from the block store when it was not kept in memory
         self.children = []  # the pointer initially points to nothing
         self.previous = previous
+        self.height = 0 if previous is None else previous.height + 1
+        # skip pointers: jumps[k] is the ancestor 2**k blocks below this one
+        self.jumps = []
+        ancestor = previous
+        while ancestor is not None:
+            self.jumps.append(ancestor)
+            k = len(self.jumps) - 1
+            ancestor = ancestor.jumps[k] if k < len(ancestor.jumps) else None
+        self.chain_work = 0 if previous is None else previous.chain_work + block_work()  # work from genesis up to here
+        self.delta = None  # balance and nonce changes made by this block
+        self.undo = None  # values the block overwrote when it was last connected to the best chain
+        self.state = None  # snapshot of the account state, only kept at checkpoints
+
+    @property
+    def block(self):
+        if self._block is None:
+            self._block = self.loader()
+        return self._block
+
+    def get_ancestor(self, height):
+        """Ancestor of this node at the given height, in O(log n) jumps"""
+        if height < 0 or height > self.height:
+            return None
+        node = self
+        distance = self.height - height
+        k = 0
+        while distance:
+            if distance & 1:
+                node = node.jumps[k]
+            distance >>= 1
+            k += 1
+        return node
+
+
+def locked(method):
+    """
+    Run the method holding the chain's lock. Mining, listener and user threads all add blocks
+    and query the account state, which follows the best chain in place.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Blockchain:
     difficulty = 5
 
-    def __init__(self):
+    def __init__(self, store=None):
         """
         Constructor for the `Blockchain` class.
+        :param store: optional BlockStore, blocks already in it are reloaded and new blocks are appended to it
         """
         # self.unconfirmed_transactions = []  # data yet to get into blockchain
+        self.lock = threading.RLock()  # tip listeners run holding it and may query the chain again
         self.root = self.create_genesis_block()
         self.root_node = Node(None, self.root)
+        self.state_engine = StateEngine()
+        self.state_engine.init_root(self.root_node)
         self.last_nodes = []
         self.last_nodes.append(self.root_node)
-        self.nodes = [self.root_node]
+        self.nodes_by_hash = {self.root.header_hash: self.root_node}  # block hash -> Node
+        self.tx_index = {}  # txid -> (block hash, leaf index) for transactions on the best chain
+        self.best_node = self.root_node  # tip with the most accumulated work
+        self.tip_listeners = []  # callbacks taking (old tip, new tip) whenever best_node moves
+        self.store = store
+        if store is not None:
+            self.load_store()
         # self.public_keys_nonce = {}
 
     @classmethod
-    def new(cls, prev_blks):
+    def new(cls, prev_blks, verify=False):
+        """
+        Chain made of prev_blks, blocks ordered from tip to root as returned by get_blks().
+        The blocks are shared with the source chain rather than copied.
+        """
         blockchain = cls()
-        blks = []
-        for i in range(len(prev_blks)):
-            blk_str = prev_blks[i].serialize()
-            block = Block.deserialize(blk_str)
-            blks.append(block)
-        blockchain.root = blks[-1]
+        blockchain.root = prev_blks[-1]
         blockchain.root_node = Node(None, blockchain.root)
+        blockchain.state_engine.init_root(blockchain.root_node)
         blockchain.last_nodes = []
         blockchain.last_nodes.append(blockchain.root_node)
-        blockchain.nodes = [blockchain.root_node]
-        for i in range(-2, -len(blks) - 1, -1):
-            blockchain.add(blks[i], blks[i].compute_hash())
+        blockchain.nodes_by_hash = {blockchain.root.header_hash: blockchain.root_node}
+        blockchain.best_node = blockchain.root_node
+        blockchain.import_blocks(prev_blks[-2::-1], verify)
         return blockchain
 
+    @locked
+    def import_blocks(self, blocks, verify=False):
+        """
+        Bulk insert a contiguous segment of already-linked blocks, ordered from parent to child,
+        in a single pass. Hashes stored on the blocks are trusted unless verify is set, in which case
+        every proof is checked. Account state and the transaction index catch up lazily.
+        The whole segment is checked before any block is attached, so a segment that does not link
+        up is rejected as a whole. Imported blocks are appended to the block store, if any.
+        """
+        if not blocks:
+            return True
+        parent_node = self.get_node_from_block_hash(blocks[0].previous_hash)
+        if parent_node is None:
+            return False
+        previous_hash = blocks[0].previous_hash
+        seen = set()
+        for block in blocks:
+            if (block.previous_hash != previous_hash or block.hash in seen
+                    or self.get_node_from_block_hash(block.hash) is not None):
+                return False
+            if verify and not self.is_valid_proof(block, block.hash):
+                return False
+            seen.add(block.hash)
+            previous_hash = block.hash
+        for block in blocks:
+            node = Node(parent_node, block)
+            self.attach_node(parent_node, node, block.hash)
+            if self.store is not None:
+                self.store.append(block)
+            parent_node = node
+        return True
+
+    @classmethod
+    def open(cls, directory):
+        """Blockchain persisted in directory, reopening the blocks stored there by a previous run"""
+        return cls(BlockStore(directory))
+
+    def load_store(self):
+        """
+        Rebuild the block tree from the store index. Block bodies stay on disk until a node's block
+        is accessed; account state and the transaction index catch up lazily from them.
+        """
+        for record in self.store.records():
+            parent_node = self.nodes_by_hash.get(record.prev_hash)
+            if parent_node is None or record.hash in self.nodes_by_hash:
+                continue
+            loader = functools.partial(self.store.read_block, record.offset, record.length)
+            self.attach_node(parent_node, Node(parent_node, None, loader), record.hash)
+
+    def attach_node(self, parent_node, node, block_hash):
+        """Link a node whose state is computed lazily into the tree, without notifying tip listeners"""
+        parent_node.children.append(node)
+        self.nodes_by_hash[block_hash] = node
+        if len(parent_node.children) == 1:
+            self.last_nodes.remove(parent_node)
+        self.last_nodes.append(node)
+        if node.chain_work >= self.best_node.chain_work:
+            self.best_node = node
+
     def create_genesis_block(self):
         """
         A function to generate genesis block and appends it to
@@ -55,11 +173,11 @@ class Blockchain:
         """
         genesis_block = Block([], 0, "0", None)
         genesis_block.blk_height = 0
-        genesis_block.hash = genesis_block.compute_hash()
+        genesis_block.hash = genesis_block.header_hash
         return genesis_block
     @property
     def length(self):
-        return self.last_node.block.blk_height
+        return self.last_node.height
 
     @property
     def last_node(self):
@@ -67,22 +185,39 @@ class Blockchain:
         A quick pythonic way to retrieve the most recent block in the chain. Note that
         the chain will always consist of at least one block (i.e., genesis block)
         """
-        return self.resolve()
+        return self.best_node
 
     def resolve(self):
-        idx = -1
+        # full rescan of the tips, best_node is kept equal to this as blocks are added
+        work = -1
         last_node = None
         for node in self.last_nodes:
-            if node.block.blk_height >= idx:
-                idx = node.block.blk_height
+            if node.chain_work >= work:
+                work = node.chain_work
                 last_node = node
         return last_node
 
-    def proof_of_work(self, block):
+    def add_tip_listener(self, callback):
+        """Register callback(old_tip, new_tip), called whenever the best tip changes"""
+        self.tip_listeners.append(callback)
+
+    def set_best_node(self, node):
+        old_tip = self.best_node
+        self.best_node = node
+        self.update_active_chain()
+        for callback in self.tip_listeners:
+            callback(old_tip, node)
+
+    def proof_of_work(self, block, pow_engine=None):
         """
         Function that tries different values of the nonce to get a hash
         that satisfies our difficulty criteria.
+        A pow_engine.PowEngine can be given to run the search instead, None is returned
+        if it was cancelled before finding a proof.
         """
+        if pow_engine is not None:
+            result = pow_engine.search(block, TARGET)
+            return result.hash if result is not None else None
         block.nonce = random.randint(0,1000000000)
 
         computed_hash = block.compute_hash()
@@ -96,6 +231,7 @@ class Blockchain:
 
         return computed_hash
 
+    @locked
     def add_block(self, block, proof):
         """
         A function that adds the block to the chain after verification.
@@ -105,10 +241,9 @@ class Blockchain:
           in the chain match.
         """
         # if previous_block is not None:
-        for node in self.nodes:
-            if node.block.compute_hash() == block.previous_hash:
-                parent_node = node
-                break;
+        parent_node = self.nodes_by_hash.get(block.previous_hash)
+        if parent_node is None or proof in self.nodes_by_hash:
+            return False
         # else:
         #     parent_node = self.last_node
         previous_hash = parent_node.block.hash
@@ -117,18 +252,22 @@ class Blockchain:
 
         if not self.is_valid_proof(block, proof):
             return False
-        block.blk_height = parent_node.block.blk_height + 1
+        block.blk_height = parent_node.height + 1
         block.hash = proof
         current_node = Node(parent_node, block)
         parent_node.children.append(current_node)
-        self.nodes.append(current_node)
+        self.nodes_by_hash[proof] = current_node
         # if previous_block is None:
         #     self.last_nodes.remove(parent_node)
-        for  node in self.last_nodes:
-            if len(node.children) != 0:
-                self.last_nodes.remove(node)
-            # self.last_nodes.remove(parent_node)
+        if len(parent_node.children) == 1:
+            # parent was a tip until now
+            self.last_nodes.remove(parent_node)
         self.last_nodes.append(current_node)
+        # ties go to the newest tip, as with the former height-based resolve()
+        if current_node.chain_work >= self.best_node.chain_work:
+            self.set_best_node(current_node)
+        if self.store is not None:
+            self.store.append(block)
         #
         # for transaction in block.transactions:
         #     tx = Transaction.deserialize(transaction)
@@ -145,7 +284,7 @@ class Blockchain:
         the difficulty criteria.
         """
         return (block_hash < TARGET and
-                block_hash == block.compute_hash())
+                block_hash == block.header_hash)
 
     # def add_new_transaction(self, transaction):
     #     self.unconfirmed_transactions.append(transaction)
@@ -171,9 +310,8 @@ class Blockchain:
         #
         # proof = self.proof_of_work(new_block)
         # if previous_block is None:
-        for node in self.nodes:
-            if new_block.compute_hash() == node.block.compute_hash():
-                return False
+        if new_block.header_hash in self.nodes_by_hash:
+            return False
         added = self.add_block(new_block, proof)
         # else:
         #     added = self.add_block(new_block, proof, previous_block)
@@ -196,66 +334,243 @@ class Blockchain:
     def get_proof(self, transaction):
         # returns proofs of merkle tree and the block that the transaction is located in
         #Transaction
-        last_node = self.last_node
-        while last_node.block.hash != self.root.hash and transaction not in last_node.block.transactions:
-            last_node = last_node.previous
-        if last_node.block.hash == self.root.hash:
-            return None, last_node.block
-        proofs = last_node.block.merkle.get_proof(transaction)
-        return proofs, last_node.block
+        return self.get_proof_by_txid(MerkleTree.compute_hash(transaction))
+
+    @locked
+    def get_proof_by_txid(self, txid):
+        # same as get_proof for a transaction id (Transaction.txid)
+        self.update_active_chain()  # catches up after a reload from the block store or a bulk import
+        location = self.tx_index.get(txid)
+        if location is None:
+            return None, self.root
+        block_hash, leaf_index = location
+        block = self.nodes_by_hash[block_hash].block
+        proofs = block.merkle.get_proof_by_index(leaf_index)
+        return proofs, block
+
+    def get_block_at_height(self, height, block_hash=None):
+        """Block at the given height on the chain ending at block_hash (default: the tip)"""
+        if block_hash is None:
+            node = self.last_node
+        else:
+            node = self.get_node_from_block_hash(block_hash)
+        ancestor = node.get_ancestor(height)
+        return ancestor.block if ancestor is not None else None
+
+    def on_best_chain(self, block_hash):
+        """Whether the block with block_hash is on the chain ending at the best tip"""
+        node = self.get_node_from_block_hash(block_hash)
+        return node is not None and self.last_node.get_ancestor(node.height) is node
+
+    def find_fork(self, old_hash, new_hash):
+        """
+        Returns the common ancestor node of two blocks, the nodes to disconnect to leave old_hash
+        and the nodes to connect to reach new_hash. See fork_path.
+        """
+        return fork_path(self.get_node_from_block_hash(old_hash), self.get_node_from_block_hash(new_hash))
+
+    @locked
+    def update_active_chain(self):
+        """
+        Move the account state and the transaction index from the previous best chain to the
+        current one by disconnecting blocks back to the fork point with their undo records and
+        connecting the new branch. The cost depends on the depth of the reorg only.
+        """
+        new_tip = self.best_node
+        active_tip = self.state_engine.active_node
+        if new_tip is active_tip:
+            return
+        _, disconnect, connect = fork_path(active_tip, new_tip)
+        for node in disconnect:
+            self.state_engine.disconnect(node)
+            self.disconnect_txs(node)
+        for node in connect:
+            self.state_engine.connect(node)
+            self.connect_txs(node)
 
+    def connect_txs(self, node):
+        block = node.block
+        for leaf_index in range(len(block.transactions)):
+            self.tx_index[block.merkle.leaves[leaf_index].hash] = (block.hash, leaf_index)
+
+    def disconnect_txs(self, node):
+        block = node.block
+        for leaf_index in range(len(block.transactions)):
+            txid = block.merkle.leaves[leaf_index].hash
+            if self.tx_index.get(txid) == (block.hash, leaf_index):
+                del self.tx_index[txid]
+
+    @locked
     def get_nonce(self, public_key, block_hash=None):
-        public_keys_nonce = {}
-        blocks = self.get_blks(block_hash)
-        for block in blocks:
-            for transaction in block.transactions:
-                tx = Transaction.deserialize(transaction)
-                sender_string = stringify_key(tx.sender)
-                if sender_string not in public_keys_nonce.keys():
-                    public_keys_nonce[sender_string] = 0
-                else:
-                    public_keys_nonce[sender_string] += 1
-        ## stringified public key
-        if public_key not in public_keys_nonce.keys():
-            return -1
+        """Most recent nonce used by the stringified public key, -1 if it has never sent a transaction"""
+        self.update_active_chain()
+        if block_hash is None:
+            node = self.last_node
         else:
-            return public_keys_nonce[public_key]
+            node = self.get_node_from_block_hash(block_hash)
+        return self.state_engine.sent_count(node, public_key) - 1
 
     def get_node_from_block_hash(self, block_hash):
-        for node in self.nodes:
-            if node.block.compute_hash() == block_hash:
-                return node
-        return None
+        return self.nodes_by_hash.get(block_hash)
 
+    @locked
     def get_balance(self, block_hash=None):
-        blocks = self.get_blks(block_hash)
+        """Returns a copy of every account balance at block_hash (default: the tip)"""
+        self.update_active_chain()
+        if block_hash is None:
+            node = self.last_node
+        else:
+            node = self.get_node_from_block_hash(block_hash)
+        return dict(self.state_engine.state_at(node).balances)
 
-        balance = {}
-        for block in blocks:
-            if block == self.root:
-                continue
-            miner_string = stringify_key(block.miner)
-            if miner_string not in balance.keys():
-                balance[miner_string] = 100
-            else:
-                balance[miner_string] += 100
-            for transaction in block.transactions:
-                tx = Transaction.deserialize(transaction)
-                sender_string = stringify_key(tx.sender)
-                if sender_string not in balance.keys():
-                    balance[sender_string] = -tx.amount
-                else:
-                    balance[sender_string] -= tx.amount
-                receiver_string = stringify_key(tx.receiver)
-                if receiver_string not in balance.keys():
-                    balance[receiver_string] = tx.amount
-                else:
-                    balance[receiver_string] += tx.amount
-        return balance
+    @locked
+    def get_account_balance(self, identifier, block_hash=None):
+        """Balance of a single stringified public key at block_hash (default: the tip)"""
+        self.update_active_chain()
+        if block_hash is None:
+            node = self.last_node
+        else:
+            node = self.get_node_from_block_hash(block_hash)
+        return self.state_engine.balance_of(node, identifier)
 
     def print(self):
         pprint_tree(self.root_node)
 
+    def fork(self, block_hash=None):
+        """Private branch starting at block_hash (default: the tip), see ForkView"""
+        if block_hash is None:
+            fork_node = self.last_node
+        else:
+            fork_node = self.get_node_from_block_hash(block_hash)
+        return ForkView(self, fork_node)
+
+
+class ForkView(Blockchain):
+    """
+    A private chain on top of a Blockchain, as used by double spending and selfish miners.
+    Ancestor nodes are shared with the public tree, which is never modified; only the blocks
+    added to the view are stored in it. The tip of the view is the best of its own blocks,
+    or the fork node while it has none. Views are kept in memory only; blocks are added to them
+    with add() or in segments with import_blocks(), like on the public chain.
+    """
+
+    def __init__(self, blockchain, fork_node):
+        self.blockchain = blockchain
+        self.root = blockchain.root
+        self.root_node = blockchain.root_node
+        self.state_engine = blockchain.state_engine
+        self.lock = blockchain.lock  # the state engine and the ancestor nodes are shared
+        self.fork_node = fork_node
+        self.nodes_by_hash = {}  # private nodes only
+        self.branch_roots = []  # private nodes whose parent is a public node
+        self.last_nodes = [fork_node]  # tips of the view
+        self.best_node = fork_node
+        self.tip_listeners = []
+        self.store = None
+
+    def get_node_from_block_hash(self, block_hash):
+        node = self.nodes_by_hash.get(block_hash)
+        if node is None:
+            node = self.blockchain.get_node_from_block_hash(block_hash)
+        return node
+
+    @locked
+    def add_block(self, block, proof):
+        parent_node = self.get_node_from_block_hash(block.previous_hash)
+        if parent_node is None or self.get_node_from_block_hash(proof) is not None:
+            return False
+        if not self.is_valid_proof(block, proof):
+            return False
+        block.blk_height = parent_node.height + 1
+        block.hash = proof
+        current_node = Node(parent_node, block)
+        self.link_node(parent_node, current_node, proof)
+        if current_node.chain_work >= self.best_node.chain_work:
+            self.set_best_node(current_node)
+        return True
+
+    def link_node(self, parent_node, node, block_hash):
+        # public parents are never modified, children of public nodes are kept as branch roots instead
+        if self.nodes_by_hash.get(parent_node.block.hash) is parent_node:
+            parent_node.children.append(node)
+        else:
+            self.branch_roots.append(node)
+        self.nodes_by_hash[block_hash] = node
+        if parent_node in self.last_nodes:
+            self.last_nodes.remove(parent_node)
+        self.last_nodes.append(node)
+
+    def attach_node(self, parent_node, node, block_hash):
+        """Link a node into the view, without notifying tip listeners"""
+        self.link_node(parent_node, node, block_hash)
+        if node.chain_work >= self.best_node.chain_work:
+            self.best_node = node
+
+    @locked
+    def get_proof_by_txid(self, txid):
+        # private blocks are not in the public tx_index, they are searched from the tip of the view
+        node = self.best_node
+        while node.block.hash in self.nodes_by_hash:
+            txids = node.block.txids()
+            if txid in txids:
+                return node.block.merkle.get_proof_by_index(txids.index(txid)), node.block
+            node = node.previous
+        # node is the public block the private branch grows from
+        proofs, block = self.blockchain.get_proof_by_txid(txid)
+        public_node = self.blockchain.get_node_from_block_hash(block.hash)
+        if proofs is None or node.get_ancestor(public_node.height) is not public_node:
+            return None, self.root
+        return proofs, block
+
+    @locked
+    def update_active_chain(self):
+        # the view never moves the active state of the public chain, its queries replay from snapshots
+        pass
+
+    def print(self):
+        print(f"fork at height {self.fork_node.height}: {self.fork_node.block}")
+        for node in self.branch_roots:
+            pprint_tree(node)
+
+def block_work():
+    """Expected number of hashes needed to find a proof below TARGET"""
+    target = int(TARGET.ljust(64, "0"), 16)
+    return 2 ** 256 // target
+
+
+def common_ancestor(a, b):
+    """Last node shared by the branches ending at a and b, in O(log n) jumps"""
+    if a.height > b.height:
+        a = a.get_ancestor(b.height)
+    elif b.height > a.height:
+        b = b.get_ancestor(a.height)
+    if a is b:
+        return a
+    for k in range(len(a.jumps) - 1, -1, -1):
+        if k < len(a.jumps) and a.jumps[k] is not b.jumps[k]:
+            a = a.jumps[k]
+            b = b.jumps[k]
+    return a.previous
+
+
+def fork_path(old_tip, new_tip):
+    """
+    Returns the common ancestor, the nodes to disconnect (from old_tip down to the fork point)
+    and the nodes to connect (from the fork point up to new_tip) to move from one tip to the other.
+    """
+    ancestor = common_ancestor(old_tip, new_tip)
+    disconnect = []
+    while old_tip is not ancestor:
+        disconnect.append(old_tip)
+        old_tip = old_tip.previous
+    connect = []
+    while new_tip is not ancestor:
+        connect.append(new_tip)
+        new_tip = new_tip.previous
+    connect.reverse()
+    return ancestor, disconnect, connect
+
+
 def pprint_tree(node, file=None, _prefix="", _last=True):
     print(_prefix, "`- " if _last else "|- ", node.block, sep="", file=file)
     _prefix += "   " if _last else "|  "
@@ -321,9 +636,9 @@ if __name__ == "__main__":
     # #     print(node.block, node.block.blk_height)
     newChain.print()
     blockchain.print()
-    print(newChain.get_balance(screwedUpBlock.compute_hash()))
+    print(newChain.get_balance(screwedUpBlock.header_hash))
     print(blockchain.get_balance())
-    print(newChain.get_nonce(stringify_key(alice_public),screwedUpBlock.compute_hash()))
+    print(newChain.get_nonce(stringify_key(alice_public),screwedUpBlock.header_hash))
     print(blockchain.get_nonce(stringify_key(alice_public)))
     # print(verify_proof(s, proofs, block.root))
     # print(block.root)
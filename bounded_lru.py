@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+
+'''
+Thread-safe mapping that holds at most max_size items and drops the least recently used one
+beyond that. Lookups are counted as hits or misses. SignatureCache and KeyCache are built on it.
+'''
+
+
+class BoundedLRU:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def lookup(self, key):
+        """Value cached for key or None, counted as a hit or a miss"""
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def insert(self, key, value):
+        """Cache a value other than None for key, returns the one already cached if any"""
+        with self.lock:
+            value = self.items.setdefault(key, value)
+            self.items.move_to_end(key)
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
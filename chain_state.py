@@ -0,0 +1,178 @@
+from transaction import Transaction
+from algorithms import *
+
+'''
+Account/Balance state kept alongside the block tree.
+Every node records the balance and nonce changes made by its block. One mutable account state
+follows the best chain: connecting a block to it records an undo entry on the node, and a reorg
+disconnects blocks back to the fork point with those entries before connecting the new branch.
+Checkpoint nodes keep a snapshot, so queries anywhere else only replay the few blocks back to
+the nearest one.
+'''
+
+BLOCK_REWARD = 100
+CHECKPOINT_INTERVAL = 16
+
+
+class BlockDelta:
+    """Balance changes and number of sent transactions per sender made by a single block"""
+
+    def __init__(self, balances=None, nonces=None):
+        self.balances = balances if balances is not None else {}
+        self.nonces = nonces if nonces is not None else {}
+
+    @classmethod
+    def from_block(cls, block):
+        balances = {}
+        nonces = {}
+        if block.miner is not None:  # genesis block has no miner to reward
+            miner_string = stringify_key(block.miner)
+            balances[miner_string] = BLOCK_REWARD
+        for transaction in block.transactions:
+            tx = Transaction.deserialize(transaction)
+            if tx is None:
+                continue
+            sender_string = stringify_key(tx.sender)
+            balances[sender_string] = balances.get(sender_string, 0) - tx.amount
+            nonces[sender_string] = nonces.get(sender_string, 0) + 1
+            receiver_string = stringify_key(tx.receiver)
+            balances[receiver_string] = balances.get(receiver_string, 0) + tx.amount
+        return cls(balances, nonces)
+
+
+class BlockUndo:
+    """Values a block overwrote when it was connected, None for accounts it created"""
+
+    def __init__(self, balances, nonces):
+        self.balances = balances
+        self.nonces = nonces
+
+
+class AccountState:
+    """
+    Account balances and sent transaction counts (keyed by stringified public key)
+    after applying every block from genesis up to some node
+    """
+
+    def __init__(self, balances=None, nonces=None):
+        self.balances = balances if balances is not None else {}
+        self.nonces = nonces if nonces is not None else {}
+
+    def connect(self, delta):
+        """Apply a block's delta, returns the BlockUndo that reverts it"""
+        undo = BlockUndo({}, {})
+        for account, change in delta.balances.items():
+            previous = self.balances.get(account)
+            undo.balances[account] = previous
+            self.balances[account] = (previous or 0) + change
+        for sender, count in delta.nonces.items():
+            previous = self.nonces.get(sender)
+            undo.nonces[sender] = previous
+            self.nonces[sender] = (previous or 0) + count
+        return undo
+
+    def disconnect(self, undo):
+        """Revert a block using the BlockUndo recorded when it was connected"""
+        for account, previous in undo.balances.items():
+            if previous is None:
+                del self.balances[account]
+            else:
+                self.balances[account] = previous
+        for sender, previous in undo.nonces.items():
+            if previous is None:
+                del self.nonces[sender]
+            else:
+                self.nonces[sender] = previous
+
+    def copy(self):
+        return AccountState(dict(self.balances), dict(self.nonces))
+
+
+class StateEngine:
+    """
+    Keeps the account state of the best chain (self.active, the state at self.active_node) and
+    the node.delta / node.undo / node.state records of the block tree
+    """
+
+    def __init__(self, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.checkpoint_interval = checkpoint_interval
+        self.active = None
+        self.active_node = None
+
+    def init_root(self, root_node):
+        root_node.delta = BlockDelta()
+        root_node.state = AccountState()
+        self.active = AccountState()
+        self.active_node = root_node
+
+    def is_checkpoint(self, node):
+        return node.height % self.checkpoint_interval == 0
+
+    def delta_of(self, node):
+        # deltas are computed the first time a block is connected or replayed
+        if node.delta is None:
+            node.delta = BlockDelta.from_block(node.block)
+        return node.delta
+
+    def connect(self, node):
+        """Move the active state forward onto node, a child of the active node"""
+        node.undo = self.active.connect(self.delta_of(node))
+        self.active_node = node
+        if node.state is None and self.is_checkpoint(node):
+            node.state = self.active.copy()
+
+    def disconnect(self, node):
+        """Move the active state back from node, the active node, to its parent"""
+        self.active.disconnect(node.undo)
+        self.active_node = node.previous
+
+    def known_state(self, node):
+        """The state at node if it is already held somewhere, otherwise None"""
+        if node is self.active_node:
+            return self.active
+        return node.state
+
+    def state_at(self, node):
+        """
+        Returns the account state at node. The result may be shared with the tree,
+        so callers must copy it before making changes.
+        """
+        path = []
+        state = self.known_state(node)
+        while state is None:
+            path.append(node)
+            node = node.previous
+            state = self.known_state(node)
+        if not path:
+            return state
+        state = state.copy()
+        for replay_node in reversed(path):
+            state.connect(self.delta_of(replay_node))
+            if self.is_checkpoint(replay_node) or not replay_node.children:
+                # keep snapshots off the best chain too, so the next query replays less
+                replay_node.state = state.copy()
+        return state
+
+    def balance_of(self, node, account):
+        """Balance of a single account at node, without copying any account map"""
+        change = 0
+        state = self.known_state(node)
+        while state is None:
+            if self.is_checkpoint(node) or not node.children:
+                return self.state_at(node).balances.get(account, 0) + change
+            change += self.delta_of(node).balances.get(account, 0)
+            node = node.previous
+            state = self.known_state(node)
+        return state.balances.get(account, 0) + change
+
+    def sent_count(self, node, sender):
+        """Number of transactions sent by sender on the branch ending at node"""
+        count = 0
+        state = self.known_state(node)
+        while state is None:
+            if self.is_checkpoint(node) or not node.children:
+                return self.state_at(node).nonces.get(sender, 0) + count
+            count += self.delta_of(node).nonces.get(sender, 0)
+            node = node.previous
+            state = self.known_state(node)
+        return state.nonces.get(sender, 0) + count
@@ -1,7 +1,6 @@
 import sys
 import time
 import json
-import copy
 import random
 from miner import Miner, MinerListener
 from SPVClient import SPVClient
@@ -18,12 +17,13 @@ class DSMiner(Miner):
     MUTATE = 1 # a mode that start to plant private chain
     ATTACK = 2 # a mode that publish the withheld blocks to effect double spending
 
-    def __init__(self, privkey, pubkey, address, listener=MinerListener):
-        super().__init__(privkey, pubkey, address, listener=listener)
+    def __init__(self, privkey, pubkey, address, listener=MinerListener, data_dir=None):
+        super().__init__(privkey, pubkey, address, listener=listener, data_dir=data_dir)
         self.mode = DSMiner.NORMAL
         self.unwanted_tx = list() # a set of transactions that the DSClient wanna invalidate
         self.fork_block = None
         self.hidden_blocks = list()
+        self.block_template = None  # blocks go on the hidden chain, with its own pool
         #self.withheld_blocks = [] # these blocks will not be published until attack fired
 
     """DS Miner functions"""
@@ -40,7 +40,7 @@ class DSMiner(Miner):
 
     """ Override mining functions """
     def get_tx_pool(self):
-        final_tx_list = list(set(self.unconfirmed_transactions) - set(self.unwanted_tx))
+        final_tx_list = list(set(self.mempool) - set(self.unwanted_tx))
         return final_tx_list
 
     def get_last_node(self):
@@ -58,7 +58,7 @@ class DSMiner(Miner):
         self.hidden_chain.add_block(new_block, proof, self.get_last_node().block)
         self.hidden_blocks += 1
 
-        self.unconfirmed_transactions = []
+        self.mempool.clear()
         self.log(" Mined a new block +$$$$$$$$")
         print("""
                     |---------|
@@ -97,7 +97,7 @@ if __name__ == '__main__':
         miner.unwanted_tx.append(tx)
         miner.log("Starting Double Spend attack")
         # create a hidden chain to mine on
-        miner.hidden_chain = copy.deepcopy(miner.blockchain)
+        miner.hidden_chain = miner.blockchain.fork()
         miner.fork_block = miner.get_last_node().block
         miner.get_own_balance()
 
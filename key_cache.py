@@ -0,0 +1,34 @@
+import ecdsa
+from bounded_lru import BoundedLRU
+
+'''
+Interned public keys.
+Every transaction and block carries its keys encoded, and building an ecdsa.VerifyingKey means
+decoding and validating the curve point again. The network only has a few hundred accounts, so
+the parsed keys are kept by their raw encoded bytes and the same VerifyingKey object is handed
+out for every later occurrence. The cache holds at most KEY_CACHE_SIZE keys and drops the least
+recently used one beyond that.
+'''
+
+KEY_CACHE_SIZE = 4096
+
+
+class KeyCache(BoundedLRU):
+    def __init__(self, max_size=KEY_CACHE_SIZE):
+        super().__init__(max_size)
+
+    @property
+    def keys(self):
+        """Raw key bytes -> VerifyingKey, least recently used first"""
+        return self.items
+
+    def get(self, key_bytes):
+        """VerifyingKey of the raw encoded key, raises ecdsa.MalformedPointError for an invalid one"""
+        key = self.lookup(key_bytes)
+        if key is None:
+            # another thread may have parsed it meanwhile, every caller gets the same object
+            key = self.insert(key_bytes, ecdsa.VerifyingKey.from_string(key_bytes))
+        return key
+
+
+parsed_keys = KeyCache()  # shared by every entry point that parses a public key
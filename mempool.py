@@ -0,0 +1,293 @@
+import bisect
+import heapq
+import threading
+import time
+from merkle_tree import MerkleTree
+from transaction import Transaction
+from algorithms import *
+
+'''
+Pool of unconfirmed transactions kept by a miner.
+Entries are indexed by txid (Transaction.txid, as in Blockchain.tx_index and the Merkle leaves) and by
+sender, where a SenderQueue keeps them ordered by nonce. Adding, looking up and removing a
+transaction are constant time apart from keeping one sender's nonces in order.
+The pool is bounded: entries older than the TTL expire, and while it holds more than max_count
+transactions or max_bytes of JSON the entries with the smallest amount (oldest first among
+equal amounts) are evicted. Expired and evicted entries are reported to the drop listeners, so that
+a block template does not keep transactions the pool let go.
+When the best chain moves, only the accounts touched by the disconnected and connected blocks
+are checked again; transactions of disconnected blocks come back into the pool.
+'''
+
+MEMPOOL_MAX_COUNT = 10000
+MEMPOOL_MAX_BYTES = 8 * 1024 * 1024
+MEMPOOL_TTL = 3600  # seconds
+
+
+class MempoolEntry:
+    def __init__(self, tx_json, tx):
+        self.txid = tx.txid
+        self.tx_json = tx_json
+        self.size = len(tx_json)
+        self.added = time.time()
+        self.sender = stringify_key(tx.sender)
+        self.receiver = stringify_key(tx.receiver)
+        self.amount = tx.amount
+        self.nonce = tx.nonce
+
+
+class SenderQueue:
+    """Pending transactions of one sender by nonce"""
+
+    def __init__(self):
+        self.by_nonce = {}
+        self.order = []  # sorted nonces, removed ones are only dropped on the next compact()
+
+    def __len__(self):
+        return len(self.by_nonce)
+
+    def add(self, entry):
+        if len(self.order) != len(self.by_nonce):
+            self.compact()
+        self.by_nonce[entry.nonce] = entry
+        bisect.insort(self.order, entry.nonce)
+
+    def remove(self, nonce):
+        del self.by_nonce[nonce]
+
+    def compact(self):
+        self.order = [nonce for nonce in self.order if nonce in self.by_nonce]
+
+    def entries(self):
+        """Entries in increasing nonce order"""
+        if len(self.order) != len(self.by_nonce):
+            self.compact()
+        return [self.by_nonce[nonce] for nonce in self.order]
+
+
+class Mempool:
+    def __init__(self, max_count=MEMPOOL_MAX_COUNT, max_bytes=MEMPOOL_MAX_BYTES, ttl=MEMPOOL_TTL):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.RLock()  # listener threads and the mining thread share the pool
+        self.entries = {}  # txid -> MempoolEntry, in arrival order
+        self.senders = {}  # sender -> SenderQueue
+        self.bytes = 0
+        self.eviction_queue = []  # heap of (amount, added, txid), tuples of removed entries are skipped when popped
+        self.expired = 0
+        self.evicted = 0
+        self.nonce_conflicts = 0
+        self.restored = 0
+        self.invalidated = 0
+        self.dropped = []  # expired or evicted entries not yet reported to the drop listeners
+        self.drop_listeners = []  # callbacks taking a list of expired or evicted entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        """Transaction JSON strings in arrival order"""
+        with self.lock:
+            return iter([entry.tx_json for entry in self.entries.values()])
+
+    def __contains__(self, tx_json):
+        return MerkleTree.compute_hash(tx_json) in self.entries
+
+    def get(self, txid):
+        return self.entries.get(txid)
+
+    def transactions(self):
+        return list(self)
+
+    def add(self, tx_json, tx=None):
+        """
+        Add a transaction, tx is its already verified Transaction if the caller has it.
+        Returns the new MempoolEntry, or None for a duplicate, an invalid signature, a nonce
+        already used by another pending transaction of the same sender or a transaction that
+        was evicted straight away because the pool is full of higher priority ones.
+        """
+        if tx is None:
+            tx = Transaction.deserialize(tx_json)
+            if tx is None:
+                return None
+        txid = tx.txid
+        if txid in self.entries:
+            return None
+        entry = MempoolEntry(tx_json, tx)
+        try:
+            with self.lock:
+                self.expire_entries(entry.added)
+                if txid in self.entries:
+                    return None
+                queue = self.senders.get(entry.sender)
+                if queue is None:
+                    queue = self.senders[entry.sender] = SenderQueue()
+                elif entry.nonce in queue.by_nonce:
+                    self.nonce_conflicts += 1
+                    return None
+                queue.add(entry)
+                self.entries[txid] = entry
+                self.bytes += entry.size
+                heapq.heappush(self.eviction_queue, (entry.amount, entry.added, txid))
+                self.evict()
+                if txid not in self.entries:
+                    return None
+            return entry
+        finally:
+            self.report_dropped()
+
+    def add_drop_listener(self, callback):
+        """Register callback(entries), called with the entries the pool expired or evicted"""
+        self.drop_listeners.append(callback)
+
+    def report_dropped(self):
+        # listeners run without the pool lock, they may take the chain lock that reorg() is called with
+        with self.lock:
+            dropped, self.dropped = self.dropped, []
+        if dropped:
+            for callback in self.drop_listeners:
+                callback(dropped)
+
+    def expire(self, now=None):
+        """Drop the entries older than the TTL, returns how many"""
+        with self.lock:
+            expired = self.expire_entries(now)
+        self.report_dropped()
+        return expired
+
+    def expire_entries(self, now=None):
+        now = time.time() if now is None else now
+        expired = []
+        for entry in self.entries.values():  # arrival order, the oldest come first
+            if entry.added + self.ttl > now:
+                break
+            expired.append(entry.txid)
+        for txid in expired:
+            self.dropped.append(self.remove_txid(txid))
+        self.expired += len(expired)
+        return len(expired)
+
+    def evict(self):
+        """Evict the lowest priority entries until the pool is back within its budget"""
+        while len(self.entries) > self.max_count or self.bytes > self.max_bytes:
+            _, added, txid = heapq.heappop(self.eviction_queue)
+            entry = self.entries.get(txid)
+            # the tuple may be left over from an earlier stay of the same transaction in the pool
+            if entry is None or entry.added != added:
+                continue
+            self.remove_txid(txid)
+            self.evicted += 1
+            self.dropped.append(entry)
+        if len(self.eviction_queue) > 2 * len(self.entries) + 64:
+            # too many removed entries left in the heap
+            self.eviction_queue = [(entry.amount, entry.added, txid) for txid, entry in self.entries.items()]
+            heapq.heapify(self.eviction_queue)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "count": len(self.entries),
+                "bytes": self.bytes,
+                "senders": len(self.senders),
+                "max_count": self.max_count,
+                "max_bytes": self.max_bytes,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "nonce_conflicts": self.nonce_conflicts,
+                "restored": self.restored,
+                "invalidated": self.invalidated,
+            }
+
+    def remove(self, tx_json):
+        """Remove a transaction if it is pending, returns its entry or None"""
+        return self.remove_txid(MerkleTree.compute_hash(tx_json))
+
+    def remove_txid(self, txid):
+        with self.lock:
+            entry = self.entries.pop(txid, None)
+            if entry is None:
+                return None
+            self.bytes -= entry.size
+            queue = self.senders[entry.sender]
+            queue.remove(entry.nonce)
+            if not queue:
+                del self.senders[entry.sender]
+        return entry
+
+    def remove_confirmed(self, transactions):
+        """Drop the transactions of a block that has been added, returns how many were pending"""
+        return self.remove_txids(MerkleTree.compute_hash(tx_json) for tx_json in transactions)
+
+    def remove_txids(self, txids):
+        return sum(1 for txid in txids if self.remove_txid(txid) is not None)
+
+    def add_batch(self, tx_jsons, verifier):
+        """Add several transactions, their signatures are checked in one batch by verifier"""
+        tx_jsons = list(tx_jsons)
+        entries = []
+        for tx_json, valid in zip(tx_jsons, verifier.verify_batch(tx_jsons)):
+            entries.append(self.add(tx_json, Transaction.deserialize(tx_json, verify=False)) if valid else None)
+        return entries
+
+    def reorg(self, disconnected, connected, blockchain, verifier=None):
+        """
+        Update the pool after the best tip of blockchain moved, disconnected and connected are
+        the nodes that left and joined the best chain (see blockchain.fork_path).
+        Confirmed transactions are dropped, the ones of disconnected blocks are put back (with
+        their signatures checked as one batch when a verifier is given), then the pending
+        transactions of every account the blocks touched are checked again.
+        """
+        touched = set()
+        confirmed = set()
+        with self.lock:
+            for node in connected:
+                touched.update(blockchain.state_engine.delta_of(node).balances)
+                txids = node.block.txids()
+                confirmed.update(txids)
+                self.remove_txids(txids)
+            restore = []
+            for node in disconnected:
+                touched.update(blockchain.state_engine.delta_of(node).balances)
+                restore.extend(tx_json for tx_json, txid in zip(node.block.transactions, node.block.txids())
+                               if txid not in confirmed and txid not in self.entries)
+            if verifier is not None:
+                entries = self.add_batch(restore, verifier)
+            else:
+                entries = [self.add(tx_json) for tx_json in restore]
+            self.restored += sum(1 for entry in entries if entry is not None)
+            for sender in touched:
+                if sender in self.senders:
+                    self.revalidate(sender, blockchain)
+
+    def revalidate(self, sender, blockchain):
+        """
+        Drop the pending transactions of sender that the best chain makes invalid: nonces it has
+        already passed, and transactions its balance there cannot fund (taken in nonce order)
+        """
+        last_nonce = blockchain.get_nonce(sender)
+        balance = blockchain.get_account_balance(sender)
+        for entry in self.senders[sender].entries():
+            if entry.nonce <= last_nonce or entry.amount > balance:
+                self.remove_txid(entry.txid)
+                self.invalidated += 1
+            else:
+                balance -= entry.amount
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.senders = {}
+            self.bytes = 0
+            self.eviction_queue = []
+
+    def sender_queues(self):
+        """(sender, entries in nonce order) for every sender with pending transactions"""
+        with self.lock:
+            return [(sender, queue.entries()) for sender, queue in self.senders.items()]
+
+    def sender_entries(self, sender):
+        """Pending entries of sender in nonce order"""
+        with self.lock:
+            queue = self.senders.get(sender)
+            return [] if queue is None else queue.entries()
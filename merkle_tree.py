@@ -29,24 +29,72 @@ class MerkleTree():
         self.leaves = leaves
 
     def build(self, leaves):
-        # Build tree computing new root
-        num_leaves = len(leaves)
-        if num_leaves == 1:
-            return leaves[0]
-
-        parents = []
-
-        i = 0
-        while i < num_leaves:
-            left_child = leaves[i]
+        # Build tree computing new root, self.levels keeps every level from the leaves up
+        self.levels = [leaves]
+        while len(self.levels[-1]) > 1:
+            nodes = self.levels[-1]
+            parents = []
+            for i in range(0, len(nodes), 2):
+                left_child = nodes[i]
+                left_child.isLeft = True
+                right_child = nodes[i + 1] if i + 1 < len(nodes) else left_child
+                parents.append(self.create_parent(left_child, right_child))
+            self.levels.append(parents)
+        return self.levels[-1][0] if leaves else None
+
+    @classmethod
+    def from_hashes(cls, hashes):
+        # Build a tree over entries already hashed, such as transaction ids
+        tree = cls.__new__(cls)
+        tree.leaves = [MerkleNode(leaf_hash, isLeaf=True) for leaf_hash in hashes]
+        tree.root = tree.build(tree.leaves)
+        return tree
+
+    def append(self, transaction):
+        # Add a single entry, only the parents on the path from the new leaf to the root are rehashed
+        self.append_hash(MerkleTree.compute_hash(transaction))
+
+    def append_hash(self, leaf_hash):
+        # Add a single entry already hashed
+        self.leaves.append(MerkleNode(leaf_hash, isLeaf=True))
+        index = len(self.leaves) - 1
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            left = index - index % 2
+            left_child = nodes[left]
             left_child.isLeft = True
-            right_child = leaves[i + 1] if i + 1 < num_leaves else left_child
-
-            parents.append(self.create_parent(left_child, right_child))
-
-            i += 2
-
-        return self.build(parents)
+            right_child = nodes[left + 1] if left + 1 < len(nodes) else left_child
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            parents = self.levels[level + 1]
+            index //= 2
+            parent = self.create_parent(left_child, right_child)
+            if index < len(parents):
+                parents[index] = parent
+            else:
+                parents.append(parent)
+            level += 1
+        self.root = self.levels[level][0]
+
+    def copy(self):
+        # Copy of the tree that can be appended to independently, no hash is recomputed
+        tree = MerkleTree.__new__(MerkleTree)
+        tree.leaves = [MerkleNode(leaf.hash, isLeaf=True, isLeft=leaf.isLeft) for leaf in self.leaves]
+        tree.levels = [tree.leaves]
+        for nodes in self.levels[1:]:
+            children = tree.levels[-1]
+            parents = []
+            for i, node in enumerate(nodes):
+                left_child = children[2 * i]
+                right_child = children[2 * i + 1] if 2 * i + 1 < len(children) else left_child
+                parent = MerkleNode(node.hash, left_child, right_child, isLeft=node.isLeft)
+                left_child.parent = parent
+                right_child.parent = parent
+                parents.append(parent)
+            tree.levels.append(parents)
+        tree.root = tree.levels[-1][0] if tree.leaves else None
+        return tree
 
     def create_parent(self,leftchild,rightchild):
         parent = MerkleNode(self.compute_hash(leftchild.hash + rightchild.hash),leftchild,rightchild)
@@ -60,7 +108,6 @@ class MerkleTree():
     def get_proof(self, entry):
         # Get membership proof for entry
         entryHash = self.compute_hash(entry)
-        proofs = list()
         idx = -1
         for i in range(len(self.leaves)):
             if entryHash == self.leaves[i].hash:
@@ -68,7 +115,11 @@ class MerkleTree():
                 break
         if idx == -1:
             return None
+        return self.get_proof_by_index(idx)
 
+    def get_proof_by_index(self, idx):
+        # Get membership proof for the leaf at idx, walking up from the leaf only
+        proofs = list()
         parent = self.leaves[idx].parent
         if parent is None:
             return proofs
@@ -1,12 +1,17 @@
 import copy
-import random
 import sys
 import time
 from block import Block
 from transaction import Transaction
-from blockchain import Blockchain, TARGET
+from blockchain import Blockchain, TARGET, fork_path
 from algorithms import *
 from node import Node, Listener
+from pow_engine import PowEngine
+from mining_stats import MiningStats
+from block_template import BlockTemplate
+from mempool import Mempool
+from signature_verifier import SignatureVerifier
+from mining_daemon import MiningDaemon, AttemptStop
 import threading
 
 """
@@ -38,27 +43,32 @@ class MinerListener(Listener):
             self.node.log("======= Receive new block from peer")
             blk_json = json.loads(data[1:])["blk_json"]
             proof = json.loads(data[1:])["blk_proof"]
-            # stop mining
-            self.node.stop_mine.set()
+            # mining is not stopped here: on_tip_changed interrupts it once the block is valid
+            # and has moved the best tip, duplicates and blocks on stale forks leave it running
+            old_tip = self.node.blockchain.last_node
+            mining = self.node.mining_stats.mining()
             # verify it if all transactions inside the block are valid
             blk = Block.deserialize(blk_json)
             transactions = blk.transactions
-            if self.node.check_balance_and_nonce(transactions, blk.previous_hash):
+            if self.node.blockchain.get_node_from_block_hash(blk.previous_hash) is None:
+                self.node.log("Parent of the new block received is unknown! ")
+            elif not all(self.node.verifier.verify_batch(transactions)):
+                self.node.log("Invalid signatures in the new block received! ")
+            elif self.node.check_balance_and_nonce(transactions, blk.previous_hash, verify=False):
+                # the mempool follows the best chain through on_tip_changed
                 success_add = self.node.blockchain.add(blk, proof)
-                for tx in transactions:
-                    if tx in self.node.unconfirmed_transactions:
-                        self.node.unconfirmed_transactions.remove(tx)
                 self.node.log(f"Added a new block received: {success_add} with {len(transactions)} transactions")
                 self.node.blockchain.print()
 
             else:
                 self.node.log("Invalid transactions in the new block received! ")
-            self.node.stop_mine.clear()
+            if mining:
+                self.node.mining_stats.block_received(self.node.blockchain.last_node is not old_tip)
 
         elif msg_type == "t":  # new transaction
             self.node.log("======= Receive new transaction from peer")
             tx_json = json.loads(data[1:])["tx_json"]
-            self.node.add_transaction(Transaction.deserialize(tx_json))
+            self.node.add_transactions([tx_json])
 
         elif msg_type == "r":  # request for transaction proof
             self.node.log("======= Receive request for transaction proof")
@@ -108,15 +118,25 @@ class Miner(Node):
     DS_MUTATE = 1 # starts to plant private chain for double spending
     DS_ATTACK = 2 # publish the withheld blocks to effect double spending
 
-    def __init__(self, privkey, pubkey, address, listener=MinerListener):
+    def __init__(self, privkey, pubkey, address, listener=MinerListener, data_dir=None):
         print(f"address: {address}")
         super().__init__(privkey, pubkey, address, listener)
-        self.unconfirmed_transactions = []  # data yet to get into blockchain
-        self.blockchain = Blockchain()
+        self.mempool = Mempool()  # data yet to get into blockchain
+        self.verifier = SignatureVerifier()  # checks the signatures of received blocks and transactions
+        # with a data_dir the chain is kept on disk and reopened on restart
+        self.blockchain = Blockchain.open(data_dir) if data_dir is not None else Blockchain()
+        # candidate block for normal mining
+        self.block_template = BlockTemplate(self.blockchain, self.pubkey, self.mempool)
+        self.blockchain.add_tip_listener(self.on_tip_changed)
+        self.mempool.add_drop_listener(self.on_pool_dropped)
         self.my_unconfirmed_txn = list()   # all unconfirmed transactions sent by me
         self.copy_all_unconfirmed_txn = list()
 
         self.stop_mine = threading.Event()  # a indicator for whether to continue mining
+        self.pow_engine = PowEngine()  # set a ProcessPoolPowEngine to mine on several cores
+        self.mining_stats = MiningStats()
+        self.mining_lock = threading.Lock()  # held by the attempt in progress, which owns pow_engine
+        self.mining_daemon = MiningDaemon(self)  # mines continuously once started
 
 
         #attack
@@ -127,13 +147,13 @@ class Miner(Node):
         self.fork_block = None
 
     @classmethod
-    def new(cls, address):
+    def new(cls, address, data_dir=None):
         """Create new Miner instance"""
         signing_key = ecdsa.SigningKey.generate()
         verifying_key = signing_key.get_verifying_key()
         privkey = signing_key
         pubkey = verifying_key
-        return cls(privkey, pubkey, address)
+        return cls(privkey, pubkey, address, data_dir=data_dir)
 
     def get_own_balance(self):
         balance = self.get_balance(stringify_key(self.pubkey))
@@ -150,19 +170,33 @@ class Miner(Node):
 
     def get_balance(self, identifier):
         """Get balance given identifier ie. pubkey"""
-        balance = self.blockchain.get_balance()
-        if identifier not in balance:
-            return 0
-        return balance[identifier]
+        return self.blockchain.get_account_balance(identifier)
 
     def get_blk_headers(self):
         """Get headers of blocks of the longest chain"""
         blk_headers = {}
         for block in self.blockchain.get_blks():
-            blk_headers[block.compute_hash()] = block.header
+            blk_headers[block.header_hash] = block.header
 
         return blk_headers
 
+    def on_tip_changed(self, old_tip, new_tip):
+        """Called by the blockchain whenever its best tip moves"""
+        reorg = new_tip.previous is not old_tip
+        self.log(f"Best tip moved to height {new_tip.block.blk_height}{' (fork switch)' if reorg else ''}")
+        _, disconnected, connected = fork_path(old_tip, new_tip)
+        self.mempool.reorg(disconnected, connected, self.blockchain, self.verifier)
+        self.mempool.expire()
+        if self.block_template is not None:
+            self.block_template.reset(self.mempool)
+        # whatever the engine is working on no longer extends the best chain
+        self.pow_engine.cancel()
+
+    def on_pool_dropped(self, entries):
+        """Called by the mempool with the entries it expired or evicted"""
+        if self.block_template is not None:
+            self.block_template.drop(entries)
+
     """ Transactions """
 
     def make_transaction(self, receiver, amount, comment=""):
@@ -190,10 +224,30 @@ class Miner(Node):
             raise Exception("New transaction failed signature verification.")
         if not self.tx_resend_check(tx):
             raise Exception("New transaction failed resending check.")
-        tx_json = tx.serialize()
+        self.add_to_pool(tx)
 
-        self.unconfirmed_transactions.append(tx_json)
-        self.log(f"{len(self.unconfirmed_transactions)} number of unconfirmed transactions")
+    def add_transactions(self, tx_jsons):
+        """
+        Add transactions received from peers. Their signatures are verified as one batch,
+        the ones that fail a check are logged and left out.
+        """
+        for tx_json, valid in zip(tx_jsons, self.verifier.verify_batch(tx_jsons)):
+            if not valid:
+                self.log("New transaction failed signature verification.")
+                continue
+            tx = Transaction.deserialize(tx_json, verify=False)
+            if self.tx_resend_check(tx):
+                self.add_to_pool(tx)
+
+    def add_to_pool(self, tx):
+        """Add a checked transaction to the mempool and the block template"""
+        entry = self.mempool.add(tx.serialize(), tx)
+        if entry is None:
+            self.log("Transaction already pending or its nonce is taken by a pending one")
+            return
+        if self.block_template is not None:
+            self.block_template.add(entry)
+        self.log(f"{len(self.mempool)} number of unconfirmed transactions")
 
     def tx_resend_check(self, tx):
         nonce = self.blockchain.get_nonce(stringify_key(tx.sender))
@@ -211,27 +265,42 @@ class Miner(Node):
 
     """ Mining """
     def mine(self):
+        """A single mining attempt, see mining_daemon to mine continuously"""
+        time.sleep(1)
+        return self.mine_block()
+
+    def mine_block(self, interrupt=None, wait=0):
+        """
+        Try to mine one block. The attempt is abandoned when stop_mine or interrupt is set,
+        or in normal mode as soon as the block no longer extends the best tip. If another attempt
+        is running, it is waited for up to wait seconds before this one gives up.
+        """
         if self.peers is None and self.stop_mine.is_set():
             return None
 
         self.log(f"mining on block height of {self.blockchain.last_node.block.blk_height} ....\n....\n")
-        time.sleep(1)
-        tx_collection = self.get_tx_pool()
-        self.log(f"Number of unconfirmed transactions I'm mining on {len(self.get_tx_pool())}")
+        if self.mode == Miner.NORMAL and self.block_template is not None:
+            # already validated against the tip, transactions that are not valid there are left out
+            new_block = self.block_template.take()
+            tx_collection = new_block.transactions
+            self.log(f"Number of unconfirmed transactions I'm mining on {len(tx_collection)}")
+            stop = AttemptStop(new_block, [self.stop_mine, interrupt], self.blockchain)
+        else:
+            tx_collection = self.get_tx_pool()
+            self.log(f"Number of unconfirmed transactions I'm mining on {len(self.get_tx_pool())}")
 
-        if not self.check_balance_and_nonce(tx_collection, self.blockchain.last_node.block.hash):
-            raise Exception("abnormal transactions!")
-            return None
+            if not self.check_balance_and_nonce(tx_collection, self.blockchain.last_node.block.hash):
+                raise Exception("abnormal transactions!")
+                return None
 
-        new_block= self.create_new_block(tx_collection)
-        proof = self.proof_of_work(new_block, self.stop_mine)
+            new_block= self.create_new_block(tx_collection)
+            stop = AttemptStop(new_block, [self.stop_mine, interrupt])
+        proof = self.proof_of_work(new_block, stop, wait)
         if proof is None:
             return None
 
         self.log("prev_hash")
         self.blockchain.add(new_block, proof)
-        for tx in tx_collection:
-            self.unconfirmed_transactions.remove(tx)
 
         self.broadcast_blk(new_block, proof)
         self.log(" Mined a new block +$$$$$$$$")
@@ -255,7 +324,7 @@ class Miner(Node):
             pool = [x for x in unconfirm if x not in self.my_unconfirmed_txn]
 
         else:
-            pool = copy.deepcopy(self.unconfirmed_transactions)
+            pool = self.mempool.transactions()
 
         return pool
 
@@ -275,7 +344,7 @@ class Miner(Node):
 
         new_block = Block(transactions=tx_collection,
                         timestamp=time.time(),
-                        previous_hash=last_node.compute_hash(),
+                        previous_hash=last_node.header_hash,
                         miner=self.pubkey)
 
         return new_block
@@ -284,41 +353,53 @@ class Miner(Node):
         blk_json = new_blk.serialize()
         self.broadcast_message("b" + json.dumps({"blk_json": blk_json,
                                                  "blk_proof": proof}))
-        self.broadcast_message("h" + json.dumps({"blk_hash": new_blk.compute_hash(),
+        self.broadcast_message("h" + json.dumps({"blk_hash": new_blk.header_hash,
                                                  "blk_header": new_blk.header
                                                  }))
 
-    def proof_of_work(self, block, stop_mine):
+    def proof_of_work(self, block, stop_mine, wait=0):
         """
         Function that tries different values of the nonce to get a hash
         that satisfies our difficulty criteria.
+        Returns None without searching if another attempt still runs after wait seconds.
         """
-        start = time.time()
-        computed_hash = block.compute_hash()
-
-        while not computed_hash < TARGET:
-            if self.stop_mine.is_set():
-                # self.log("Stop Mining as others have found the block")
-                return None
-            random.seed(time.time())
-            block.nonce = random.randint(0, 100000000)
-            computed_hash = block.compute_hash()
+        if not self.mining_lock.acquire(timeout=wait):
+            self.log("Another mining attempt is in progress")
+            return None
+        try:
+            self.mining_stats.start_attempt()
+            result = self.pow_engine.search(block, TARGET, stop_mine)
+            self.mining_stats.end_attempt(None if result is None else result.hash)
+        finally:
+            self.mining_lock.release()
+        if result is None:
+            # self.log("Stop Mining as others have found the block")
+            return None
+        self.log(f"Worker {result.worker} found proof = {result.hash} < TARGET in {result.elapsed} seconds "
+                 f"({result.hash_rate:.0f} hashes/s)")
+        return result.hash
 
-        end = time.time()
-        self.log(f"Found proof = {computed_hash} < TARGET in {end - start} seconds")
-        return computed_hash
+    def get_mining_stats(self):
+        """
+        Snapshot of the mining counters: hashes tried and hashes per second overall and per
+        worker, attempts and their duration, attempts abandoned through stop_mine, peer blocks
+        that interrupted an attempt or left it running (avoided_interruptions) and mined
+        blocks that are not on the best chain (stale_blocks)
+        """
+        return self.mining_stats.snapshot(self.pow_engine, self.blockchain)
 
-    def check_balance_and_nonce(self, transactions, blk_hash):
+    def check_balance_and_nonce(self, transactions, blk_hash, verify=True):
         """
             Check balance state if transactions were applied.
             The balance of an account is checked to make sure it is larger than
             or equal to the spending transaction amount.
+            verify=False skips the signature checks of transactions already verified in a batch.
         """
         balance = self.blockchain.get_balance(blk_hash)
         tx_nonce = {}
 
         for tx_json in transactions:
-            recv_tx = Transaction.deserialize(tx_json)
+            recv_tx = Transaction.deserialize(tx_json, verify)
             # Sender must exist so if it doesn't, return false
 
             sender = stringify_key(recv_tx.sender)
@@ -364,7 +445,7 @@ class Miner(Node):
         self.mode = Miner.DS_MUTATE
         self.fork_block = self.get_last_node()
         # self.private_chain = copy.deepcopy(self.blockchain)
-        self.copy_all_unconfirmed_txn = copy.deepcopy(self.unconfirmed_transactions)
+        self.copy_all_unconfirmed_txn = self.mempool.transactions()
         self.ds_txns = self.create_ds_txn()
         self.log("Ready for DS attack")
         
@@ -447,8 +528,8 @@ class Miner(Node):
 
         for blk in blocks:
             self.log(f"Broadcasting block {count} out of {self.hidden_blocks_num}")
-            self.blockchain.add_block(blk, blk.compute_hash())
-            self.broadcast_blk(blk, blk.compute_hash())
+            self.blockchain.add_block(blk, blk.header_hash)
+            self.broadcast_blk(blk, blk.header_hash)
             count += 1
             time.sleep(2)
         
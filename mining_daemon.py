@@ -0,0 +1,81 @@
+import threading
+
+'''
+Continuous mining for a Miner.
+MiningDaemon runs mining attempts back to back on its own thread. An attempt ends as soon as its
+block no longer extends the best tip, so the next one starts right away on the template that the
+tip change rebuilt. start(), pause(), resume() and stop() control it from any thread.
+'''
+
+ATTEMPT_WAIT = 1  # seconds an attempt waits for one started elsewhere before checking for pause or stop again
+
+
+class AttemptStop:
+    """
+    Stop condition the PoW engine polls during a mining attempt. It is set once any of the events
+    is set or, when a blockchain is given, once block no longer extends its best tip.
+    """
+
+    def __init__(self, block, events, blockchain=None):
+        self.block = block
+        self.events = [event for event in events if event is not None]
+        self.blockchain = blockchain
+
+    def is_set(self):
+        if any(event.is_set() for event in self.events):
+            return True
+        return self.blockchain is not None and self.blockchain.last_node.block.hash != self.block.previous_hash
+
+
+class MiningDaemon:
+    def __init__(self, miner):
+        self.miner = miner
+        self.thread = None
+        self.stopping = False
+        self.resumed = threading.Event()  # set while the daemon may mine
+        self.halt = threading.Event()  # set while paused or stopping, ends the attempt in progress
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive() and self.resumed.is_set()
+
+    def start(self):
+        """Start mining continuously, or resume if paused"""
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.resume()
+
+    def pause(self):
+        """Stop the attempt in progress and wait for resume()"""
+        self.resumed.clear()
+        self.halt.set()
+        self.miner.log("Mining paused")
+
+    def resume(self):
+        self.halt.clear()
+        self.resumed.set()
+        self.miner.log("Mining started")
+
+    def stop(self):
+        """Stop the attempt in progress and end the mining thread"""
+        self.stopping = True
+        self.halt.set()
+        self.resumed.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        self.miner.log("Mining stopped")
+
+    def run(self):
+        while True:
+            self.resumed.wait()
+            if self.stopping:
+                return
+            try:
+                # a mine() call from another thread may hold the miner for a while
+                self.miner.mine_block(self.halt, wait=ATTEMPT_WAIT)
+            except Exception as e:
+                self.miner.log(f"Mining attempt failed: {e}")
+                self.pause()
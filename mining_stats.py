@@ -0,0 +1,89 @@
+import threading
+import time
+
+'''
+Mining telemetry kept by a Miner: hashes tried per worker, time spent per block attempt,
+attempts abandoned through stop_mine and mined blocks that did not stay on the best chain.
+Blocks received from peers during an attempt are counted as interruptions when they moved the
+best tip, and as avoided interruptions otherwise (duplicates, stale forks, invalid blocks).
+'''
+
+
+class MiningStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.abandoned = 0
+        self.attempt_seconds = 0.0  # total time of finished attempts
+        self.last_attempt_seconds = None
+        self.attempt_start = None  # start of the attempt in progress
+        self.mined = []  # hashes of blocks this miner found
+        self.interruptions = 0
+        self.avoided_interruptions = 0
+
+    def start_attempt(self):
+        with self.lock:
+            self.attempt_start = time.time()
+
+    def end_attempt(self, block_hash):
+        """Close the attempt in progress, block_hash is None if it was abandoned"""
+        with self.lock:
+            elapsed = time.time() - self.attempt_start
+            self.attempt_start = None
+            self.attempts += 1
+            self.attempt_seconds += elapsed
+            self.last_attempt_seconds = elapsed
+            if block_hash is None:
+                self.abandoned += 1
+            else:
+                self.mined.append(block_hash)
+
+    def mining(self):
+        """Whether an attempt is in progress"""
+        return self.attempt_start is not None
+
+    def block_received(self, moved_tip):
+        """A block from a peer arrived during an attempt, moved_tip tells whether it became the best tip"""
+        with self.lock:
+            if moved_tip:
+                self.interruptions += 1
+            else:
+                self.avoided_interruptions += 1
+
+    def mining_seconds(self):
+        """Time spent searching for proofs, including the attempt in progress"""
+        if self.attempt_start is None:
+            return self.attempt_seconds
+        return self.attempt_seconds + time.time() - self.attempt_start
+
+    def snapshot(self, pow_engine, blockchain):
+        """
+        Current counters as a dictionary. Hash counts are those of pow_engine, which counts
+        every hash its workers tried, including the ones of the attempt in progress.
+        """
+        with self.lock:
+            seconds = self.mining_seconds()
+            worker_hashes = pow_engine.worker_hashes()
+            hashes = sum(worker_hashes)
+            finished = self.attempts
+            mined = list(self.mined)
+            snapshot = {
+                "hashes": hashes,
+                "mining_seconds": seconds,
+                "hashes_per_second": hashes / seconds if seconds else 0.0,
+                "workers": [{
+                    "worker": worker,
+                    "hashes": count,
+                    "hashes_per_second": count / seconds if seconds else 0.0,
+                } for worker, count in enumerate(worker_hashes)],
+                "attempts": finished,
+                "attempt_in_progress": self.attempt_start is not None,
+                "mean_attempt_seconds": self.attempt_seconds / finished if finished else None,
+                "last_attempt_seconds": self.last_attempt_seconds,
+                "abandoned_attempts": self.abandoned,
+                "interruptions": self.interruptions,
+                "avoided_interruptions": self.avoided_interruptions,
+                "blocks_mined": len(mined),
+            }
+        snapshot["stale_blocks"] = sum(1 for block_hash in mined if not blockchain.on_best_chain(block_hash))
+        return snapshot
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import time
+
+'''
+Pluggable proof-of-work engines.
+PowEngine searches the nonce space on the calling thread; ProcessPoolPowEngine splits it into one
+range per worker process, so mining no longer competes for the GIL with the listener threads.
+The header up to the nonce is hashed once per search, every attempt then only copies that hash
+state and feeds it the nonce digits, and the digest is compared against the target as an integer.
+When the nonce space runs out the block timestamp is rolled forward and the search starts over.
+'''
+
+NONCE_SPACE = 2 ** 32
+CHECK_INTERVAL = 2048  # hashes between two checks of the stop flag
+
+
+class PowResult:
+    def __init__(self, nonce, hash, worker, hashes, elapsed):
+        self.nonce = nonce
+        self.hash = hash
+        self.worker = worker  # index of the worker that found the proof
+        self.hashes = hashes  # hashes tried by all workers for this search
+        self.elapsed = elapsed
+
+    @property
+    def hash_rate(self):
+        return self.hashes / self.elapsed if self.elapsed else 0.0
+
+
+def header_parts(block):
+    """Split the JSON header of block around its nonce, which json.dumps writes last"""
+    header = block.header
+    header["nonce"] = 0
+    prefix = json.dumps(header)[:-len("0}")]
+    return prefix.encode(), b"}"
+
+
+def target_value(target):
+    """
+    Integer form of a hex TARGET string. A 64 digit hash is below TARGET as a string exactly when
+    it is below TARGET padded with zeros to 64 digits as a number.
+    """
+    return int(target.ljust(64, "0"), 16)
+
+
+def roll_timestamp(block):
+    """Give block a new header once every nonce has been tried"""
+    block.timestamp = max(time.time(), block.timestamp + 1e-6)
+
+
+def search_range(prefix, suffix, target, start, stop, should_stop, progress=None):
+    """
+    Try nonces in [start, stop) against an integer target. Returns (nonce, hash, hashes tried),
+    nonce is None when the range ran out or should_stop() returned True.
+    progress, if given, is called with the number of hashes tried since its previous call.
+    """
+    midstate = hashlib.sha256(prefix)
+    nonce_format = b"%d" + suffix.replace(b"%", b"%%")
+    from_bytes = int.from_bytes
+    nonce = start
+    while nonce < stop:
+        chunk_start = nonce
+        for nonce in range(nonce, min(nonce + CHECK_INTERVAL, stop)):
+            attempt = midstate.copy()
+            attempt.update(nonce_format % nonce)
+            digest = attempt.digest()
+            if from_bytes(digest, "big") < target:
+                if progress is not None:
+                    progress(nonce - chunk_start + 1)
+                return nonce, digest.hex(), nonce - start + 1
+        nonce += 1
+        if progress is not None:
+            progress(nonce - chunk_start)
+        if should_stop():
+            break
+    return None, None, nonce - start
+
+
+class PowEngine:
+    """Searches nonces sequentially on the calling thread"""
+
+    workers = 1
+    cancelled = False
+
+    def __init__(self):
+        self.hash_counts = [0]
+
+    def worker_hashes(self):
+        """Hashes tried so far by each worker over the life of the engine, updated while searching"""
+        return list(self.hash_counts)
+
+    def count_hashes(self, tried):
+        self.hash_counts[0] += tried
+
+    def search(self, block, target, stop_event=None):
+        """
+        Find a nonce such that the block hash is below target. Sets block.nonce and returns a
+        PowResult, or returns None if stop_event was set, cancel() was called or the nonce space ran out.
+        """
+        start = time.time()
+        target = target_value(target)
+        self.cancelled = False
+
+        def should_stop():
+            return self.cancelled or (stop_event is not None and stop_event.is_set())
+
+        hashes = 0
+        while True:
+            prefix, suffix = header_parts(block)
+            nonce, computed_hash, tried = search_range(prefix, suffix, target, 0, NONCE_SPACE, should_stop,
+                                                       self.count_hashes)
+            hashes += tried
+            if nonce is not None:
+                break
+            if should_stop():
+                return None
+            roll_timestamp(block)
+        block.nonce = nonce
+        return PowResult(nonce, computed_hash, 0, hashes, time.time() - start)
+
+    def cancel(self):
+        """Stop the search in progress"""
+        self.cancelled = True
+
+    def close(self):
+        pass
+
+
+def _pool_worker(worker, jobs, results, active_job, hash_counts):
+    """Worker process loop: run the nonce ranges it is given until told to exit with None"""
+
+    def count_hashes(tried):
+        hash_counts[worker] += tried
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, prefix, suffix, target, start, stop = job
+        nonce, computed_hash, tried = search_range(prefix, suffix, target, start, stop,
+                                                   lambda: active_job.value != job_id, count_hashes)
+        results.put((job_id, worker, nonce, computed_hash, tried))
+
+
+class ProcessPoolPowEngine(PowEngine):
+    """
+    Splits the nonce space into one contiguous range per worker process. Workers check a shared
+    job id every CHECK_INTERVAL hashes, so cancel() or a set stop_event stops all of them within
+    a few milliseconds.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.processes = None
+        self.hash_counts = [0] * self.workers
+        self.job_id = 0
+
+    def start(self):
+        # spawned workers start from a fresh interpreter, a forked one could inherit a lock
+        # held by another thread of the node at the time of the fork and block on it forever
+        context = multiprocessing.get_context("spawn")
+        self.jobs = [context.Queue() for _ in range(self.workers)]
+        self.results = context.Queue()
+        self.active_job = context.Value("q", 0, lock=False)
+        # each worker only writes its own slot, so the counters need no lock
+        self.hash_counts = context.Array("Q", self.hash_counts, lock=False)
+        self.processes = []
+        for worker in range(self.workers):
+            process = context.Process(target=_pool_worker,
+                                      args=(worker, self.jobs[worker], self.results, self.active_job,
+                                            self.hash_counts),
+                                      daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def search(self, block, target, stop_event=None):
+        if self.processes is None:
+            self.start()
+        start = time.time()
+        target = target_value(target)
+        hashes = 0
+        while True:
+            found, stopped, tried = self.run_job(block, target, stop_event)
+            hashes += tried
+            if found is not None:
+                break
+            if stopped:
+                return None
+            roll_timestamp(block)
+        nonce, computed_hash, worker = found
+        block.nonce = nonce
+        return PowResult(nonce, computed_hash, worker, hashes, time.time() - start)
+
+    def run_job(self, block, target, stop_event):
+        """
+        Search the whole nonce space of the current header on every worker.
+        Returns (found, stopped, hashes tried), found is (nonce, hash, worker) or None.
+        """
+        prefix, suffix = header_parts(block)
+        self.job_id += 1
+        job_id = self.job_id
+        self.active_job.value = job_id
+        span = NONCE_SPACE // self.workers
+        for worker in range(self.workers):
+            stop = NONCE_SPACE if worker == self.workers - 1 else (worker + 1) * span
+            self.jobs[worker].put((job_id, prefix, suffix, target, worker * span, stop))
+
+        found = None
+        hashes = 0
+        pending = self.workers
+        while pending:
+            if stop_event is not None and stop_event.is_set():
+                self.cancel()
+            try:
+                result_job, worker, nonce, computed_hash, tried = self.results.get(timeout=0.005)
+            except queue.Empty:
+                continue
+            if result_job != job_id:
+                continue  # report of an earlier, cancelled search
+            pending -= 1
+            hashes += tried
+            if nonce is not None and found is None:
+                found = (nonce, computed_hash, worker)
+                self.cancel()
+        # the job is still active only if every worker ran out of nonces
+        stopped = self.active_job.value != job_id
+        return found, stopped, hashes
+
+    def cancel(self):
+        """Stop the search in progress on every worker"""
+        if self.processes is not None:
+            self.active_job.value = 0
+
+    def close(self):
+        if self.processes is None:
+            return
+        self.cancel()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=1)
+        self.processes = None
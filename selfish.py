@@ -1,4 +1,3 @@
-import copy
 import time
 import sys
 import json
@@ -21,9 +20,9 @@ class SelfishMinerListener(MinerListener):
 class SelfishMiner(Miner):
     """Selfish Miner class"""
 
-    def __init__(self, privkey, pubkey, address, listener=MinerListener):
-        super().__init__(privkey, pubkey, address, listener=SelfishMinerListener)
-        self.hidden_chain = copy.deepcopy(self.blockchain)
+    def __init__(self, privkey, pubkey, address, listener=MinerListener, data_dir=None):
+        super().__init__(privkey, pubkey, address, listener=SelfishMinerListener, data_dir=data_dir)
+        self.hidden_chain = self.blockchain.fork()
         self.hidden_blocks = 0
     
     def get_longest_len(self, chain):
@@ -52,7 +51,7 @@ class SelfishMiner(Miner):
         self.hidden_chain.add_block(new_block, proof, self.get_last_node())
         self.hidden_blocks += 1
 
-        self.unconfirmed_transactions = []
+        self.mempool.clear()
         print(f"{self.type} at {self.address} created a block.")
 
         return new_block, prev_block
@@ -424,6 +424,8 @@ from transaction import Transaction
 from blockchain import Blockchain, TARGET
 from algorithms import *
 from node import Node, Listener
+from pow_engine import PowEngine
+from mempool import Mempool
 import threading
 
 """
@@ -465,30 +467,27 @@ class SelfishMinerListener(Listener):
                 delta_previous = self.node.private_blockchain.length - self.node.blockchain.length
                 success_add = self.node.blockchain.add(blk, proof)
                 if delta_previous == 0:
-                    public_blks = self.node.blockchain.get_blks()
-                    self.node.private_blockchain = Blockchain.new(public_blks)
+                    self.node.private_blockchain = self.node.blockchain.fork()
                     self.node.privateBranchLen = 0
                 elif delta_previous == 1:
                     self.node.broadcast_blk(self.node.private_blockchain.last_node.block,
-                                            self.node.private_blockchain.last_node.block.compute_hash())
+                                            self.node.private_blockchain.last_node.block.header_hash)
                     self.node.blockchain.add(self.node.private_blockchain.last_node.block,
-                                             self.node.private_blockchain.last_node.block.compute_hash())
+                                             self.node.private_blockchain.last_node.block.header_hash)
                 elif delta_previous == 2:
 
                     blks = self.node.private_blockchain.get_blks()
                     for i in range(self.node.privateBranchLen - 1, -1, -1):
-                        self.node.broadcast_blk(blks[i], blks[i].compute_hash())
-                        self.node.blockchain.add(blks[i], blks[i].compute_hash())
+                        self.node.broadcast_blk(blks[i], blks[i].header_hash)
+                        self.node.blockchain.add(blks[i], blks[i].header_hash)
                     self.privateBranchLen = 0
                 else:
                     last_node = self.node.private_blockchain.last_node
                     for i in range(self.node.privateBranchLen - 1):
                         last_node = last_node.previous
-                    self.node.broadcast_blk(last_node.block, last_node.block.compute_hash())
-                    self.node.blockchain.add(last_node.block, last_node.block.compute_hash())
-                for tx in transactions:
-                    if tx in self.node.unconfirmed_transactions:
-                        self.node.unconfirmed_transactions.remove(tx)
+                    self.node.broadcast_blk(last_node.block, last_node.block.header_hash)
+                    self.node.blockchain.add(last_node.block, last_node.block.header_hash)
+                self.node.mempool.remove_confirmed(transactions)
                 self.node.log(f"Added a new block received: {success_add} with {len(transactions)} transactions")
                 self.node.log("Public Blockchain")
                 self.node.log(self.node.blockchain.print())
@@ -556,12 +555,13 @@ class SelfishMiner(Node):
     def __init__(self, privkey, pubkey, address, listener=SelfishMinerListener):
         print(f"address: {address}")
         super().__init__(privkey, pubkey, address, listener)
-        self.unconfirmed_transactions = []  # data yet to get into blockchain
+        self.mempool = Mempool()  # data yet to get into blockchain
         self.blockchain = Blockchain()
-        self.private_blockchain = Blockchain()
+        self.private_blockchain = self.blockchain.fork()
         self.my_unconfirmed_txn = list()  # all unconfirmed transactions sent by me
 
         self.stop_mine = threading.Event()  # a indicator for whether to continue mining
+        self.pow_engine = PowEngine()  # set a ProcessPoolPowEngine to mine on several cores
         self.privateBranchLen = 0
 
         # attack
@@ -594,16 +594,13 @@ class SelfishMiner(Node):
 
     def get_balance(self, identifier):
         """Get balance given identifier ie. pubkey"""
-        balance = self.blockchain.get_balance()
-        if identifier not in balance:
-            return 0
-        return balance[identifier]
+        return self.blockchain.get_account_balance(identifier)
 
     def get_blk_headers(self):
         """Get headers of blocks of the longest chain"""
         blk_headers = {}
         for block in self.blockchain.get_blks():
-            blk_headers[block.compute_hash()] = block.header
+            blk_headers[block.header_hash] = block.header
 
         return blk_headers
 
@@ -637,8 +634,10 @@ class SelfishMiner(Node):
             raise Exception("New transaction failed resending check.")
         tx_json = tx.serialize()
 
-        self.unconfirmed_transactions.append(tx_json)
-        self.log(f"{len(self.unconfirmed_transactions)} number of unconfirmed transactions")
+        if self.mempool.add(tx_json, tx) is None:
+            self.log("Transaction already pending or its nonce is taken by a pending one")
+            return
+        self.log(f"{len(self.mempool)} number of unconfirmed transactions")
 
     def tx_resend_check(self, tx):
         nonce = self.blockchain.get_nonce(stringify_key(tx.sender))
@@ -671,15 +670,15 @@ class SelfishMiner(Node):
         delta_previous = self.private_blockchain.length - self.blockchain.length
         self.private_blockchain.add(new_block, proof)
 
+        self.mempool.remove_confirmed(tx_collection)
         for tx in tx_collection:
-            self.unconfirmed_transactions.remove(tx)
             self.my_unconfirmed_txn.remove(tx)
         self.privateBranchLen += 1
         if (delta_previous ==0 and self.privateBranchLen ==2):
             broadcast_blks = self.private_blockchain.get_blks()
             for i in range(self.privateBranchLen - 1, -1, -1):
-                self.broadcast_blk(broadcast_blks[i], broadcast_blks[i].compute_hash())
-                self.blockchain.add(broadcast_blks[i], broadcast_blks[i].compute_hash())
+                self.broadcast_blk(broadcast_blks[i], broadcast_blks[i].header_hash)
+                self.blockchain.add(broadcast_blks[i], broadcast_blks[i].header_hash)
             self.privateBranchLen = 0
         # self.broadcast_blk(new_block, proof)
         self.log(" Mined a new block +$$$$$$$$")
@@ -752,7 +751,7 @@ class SelfishMiner(Node):
             # print(f"Length of final pool: {len(pool)}")
             pool = copy.deepcopy(self.ds_txns)
         else:
-            pool = copy.deepcopy(self.unconfirmed_transactions)
+            pool = self.mempool.transactions()
 
         self.log(
             f"****DEBUG****\nCurrent no. of unconfirmed transaction pool is {len(pool)} for miner in mode: {self.mode}")
@@ -783,7 +782,7 @@ class SelfishMiner(Node):
         blk_json = new_blk.serialize()
         self.broadcast_message("b" + json.dumps({"blk_json": blk_json,
                                                  "blk_proof": proof}))
-        self.broadcast_message("h" + json.dumps({"blk_hash": new_blk.compute_hash(),
+        self.broadcast_message("h" + json.dumps({"blk_hash": new_blk.header_hash,
                                                  "blk_header": new_blk.header
                                                  }))
 
@@ -792,20 +791,12 @@ class SelfishMiner(Node):
         Function that tries different values of the nonce to get a hash
         that satisfies our difficulty criteria.
         """
-        start = time.time()
-        computed_hash = block.compute_hash()
-
-        while not computed_hash < TARGET:
-            if self.stop_mine.is_set():
-                # self.log("Stop Mining as others have found the block")
-                return None
-            random.seed(time.time())
-            block.nonce = random.randint(0, 100000000)
-            computed_hash = block.compute_hash()
-
-        end = time.time()
-        self.log(f"Found proof = {computed_hash} < TARGET in {end - start} seconds")
-        return computed_hash
+        result = self.pow_engine.search(block, TARGET, stop_mine)
+        if result is None:
+            # self.log("Stop Mining as others have found the block")
+            return None
+        self.log(f"Worker {result.worker} found proof = {result.hash} < TARGET in {result.elapsed} seconds")
+        return result.hash
 
     def check_final_balance(self, transactions):
         """
@@ -848,7 +839,7 @@ class SelfishMiner(Node):
         self.mode = SelfishMiner.DS_MUTATE
         self.log(f"Current miner mode is now {self.mode}")
         self.fork_block = self.get_last_node()
-        self.private_chain = copy.deepcopy(self.blockchain)
+        self.private_chain = self.blockchain.fork()
         self.ds_txns = self.create_ds_txn()
         self.log("Ready for DS attack")
 
@@ -908,9 +899,7 @@ class SelfishMiner(Node):
             self.hidden_blocks.append(new_block)
             self.hidden_blocks_num += 1
 
-            for tx in tx_collection:
-                if tx in self.unconfirmed_transactions:
-                    self.unconfirmed_transactions.remove(tx)
+            self.mempool.remove_confirmed(tx_collection)
 
             self.log(" Mined a new block +$$$$$$$$")
             print("""
@@ -931,7 +920,7 @@ class SelfishMiner(Node):
 
         for i in range(self.hidden_blocks_num - 1, 0, -1):
             self.log(f"Broadcasting block number {i} out of {self.hidden_blocks_num}")
-            self.broadcast_blk(blocks[i], blocks[i].compute_hash())
+            self.broadcast_blk(blocks[i], blocks[i].header_hash)
             time.sleep(2)
 
         self.end_ds_attack()
@@ -0,0 +1,32 @@
+from bounded_lru import BoundedLRU
+
+'''
+Cache of the transactions whose signature has already been verified.
+A transaction is keyed by its txid, the hash of its JSON (MerkleTree.compute_hash), which covers
+the sender key, the signed fields and the signature, so a cached txid stands for a verification
+that would succeed again. Only successful verifications are cached. The cache is bounded and
+drops the least recently used txids first; hits and misses are counted.
+'''
+
+SIGNATURE_CACHE_SIZE = 100000
+
+
+class SignatureCache(BoundedLRU):
+    def __init__(self, max_size=SIGNATURE_CACHE_SIZE):
+        super().__init__(max_size)
+
+    @property
+    def txids(self):
+        """Verified txids, least recently used first"""
+        return self.items
+
+    def check(self, txid):
+        """Whether the signature of txid has been verified, counted as a hit or a miss"""
+        return self.lookup(txid) is not None
+
+    def add(self, txid):
+        """Record a successful verification"""
+        self.insert(txid, True)
+
+
+verified_signatures = SignatureCache()  # shared by every Transaction of the process
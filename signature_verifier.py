@@ -0,0 +1,69 @@
+import concurrent.futures
+import multiprocessing
+import os
+from merkle_tree import MerkleTree
+from signature_cache import verified_signatures
+from transaction import Transaction
+
+'''
+Batch signature verification.
+Pure Python ECDSA takes milliseconds per signature, so a block or a burst of transactions is
+verified as one batch: the batch is split into chunks that run on a pool of worker processes,
+and the caller gets back one result per transaction. Small batches are verified in the calling
+thread, where the round trip to the pool would cost more than it saves. Transactions found in
+verified_signatures are not verified again, and the ones that pass are added to it.
+'''
+
+MIN_POOL_BATCH = 8  # smaller batches are verified in the calling thread
+CHUNKS_PER_WORKER = 4
+
+
+def verify_transaction(tx_json):
+    """Whether tx_json parses and carries a valid signature of its sender"""
+    try:
+        return Transaction.deserialize(tx_json, verify=False).verify_signature()
+    except Exception:
+        # malformed JSON or keys, or ecdsa.keys.BadSignatureError
+        return False
+
+
+def verify_chunk(tx_jsons):
+    return [verify_transaction(tx_json) for tx_json in tx_jsons]
+
+
+class SignatureVerifier:
+    def __init__(self, workers=None, min_pool_batch=MIN_POOL_BATCH):
+        self.workers = workers or os.cpu_count()
+        self.min_pool_batch = min_pool_batch
+        self.pool = None
+
+    def verify_batch(self, tx_jsons):
+        """List of booleans, whether each transaction's signature is valid"""
+        tx_jsons = list(tx_jsons)
+        txids = [MerkleTree.compute_hash(tx_json) for tx_json in tx_jsons]
+        results = [verified_signatures.check(txid) for txid in txids]
+        pending = [i for i, verified in enumerate(results) if not verified]
+        for i, valid in zip(pending, self.verify_uncached([tx_jsons[i] for i in pending])):
+            if valid:
+                verified_signatures.add(txids[i])
+            results[i] = valid
+        return results
+
+    def verify_uncached(self, tx_jsons):
+        if len(tx_jsons) < self.min_pool_batch:
+            return verify_chunk(tx_jsons)
+        if self.pool is None:
+            # forked workers would inherit locks held by other threads, such as the one of parsed_keys
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                               mp_context=multiprocessing.get_context("spawn"))
+        chunk_size = -(-len(tx_jsons) // (self.workers * CHUNKS_PER_WORKER))
+        chunks = [tx_jsons[i:i + chunk_size] for i in range(0, len(tx_jsons), chunk_size)]
+        results = []
+        for chunk_results in self.pool.map(verify_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -10,9 +10,13 @@ import sys
 import timeit
 from ecdsa import SigningKey
 from merkle_tree import *
+from signature_cache import verified_signatures
+from key_cache import parsed_keys
 import ecdsa
 import base64
+import binascii
 import random
+import struct
 
 def H(n, msg):
     m = hashlib.sha512(msg.encode('utf-8')).digest()
@@ -57,7 +61,31 @@ def preImage(image):
         counter += 1
 
 
+# Binary encoding: version, sender, receiver, signature, amount, nonce and comment length,
+# followed by the UTF-8 comment. Keys and signatures are raw NIST192p values of 48 bytes.
+TX_FORMAT_VERSION = 1
+TX_HEADER = struct.Struct(">B48s48s48sqqH")
+KEY_SIZE = 48
+SIGNATURE_SIZE = 48
+# json.dumps() of the fields dictionary, written out so that encoding does not build a dictionary
+CANONICAL_JSON = '{"sender": %s, "receiver": %s, "nonce": %s, "amount": %s, "comment": %s, "signature": %s}'
+
+
+def json_base64(data):
+    # json.dumps(base64.encodebytes(data).decode('ascii')), the only character to escape is the newline
+    if 0 < len(data) <= 57:
+        # a single line, which b2a_base64 encodes the same way without encodebytes' line splitting
+        return '"' + binascii.b2a_base64(data)[:-1].decode('ascii') + '\\n"'
+    return '"' + base64.encodebytes(data).decode('ascii').replace('\n', '\\n') + '"'
+
+
+def json_value(value):
+    return str(value) if type(value) is int else json.dumps(value)
+
+
 class Transaction:
+    FIELDS = ("sender", "receiver", "amount", "comment", "signature", "nonce")
+
     def __init__(self, sender, receiver, amount, comment, nonce, signature=b""):
         self.sender = sender
         self.receiver = receiver
@@ -65,6 +93,9 @@ class Transaction:
         self.comment = comment
         self.signature = signature
         self.nonce = nonce
+        self._json = None  # the JSON the transaction was read from, see deserialize()
+        self._bytes = None  # the binary encoding the transaction was read from, see from_bytes()
+        self._txid = None
 
 
     # Instantiates object from passed values
@@ -92,26 +123,51 @@ class Transaction:
 
     def serialize(self):
         # Serializes object to CBOR or JSON string
-        dic = {}
-        dic['sender'] = base64.encodebytes(self.sender.to_string()).decode('ascii')
-        dic['receiver'] = base64.encodebytes(self.receiver.to_string()).decode("ascii")
-        dic['nonce'] = self.nonce
-        dic['amount'] = self.amount
-        dic['comment'] = self.comment
-        dic['signature'] = base64.encodebytes(self.signature).decode('ascii')
-        serialized = json.dumps(dic)
-        return serialized
+        # A transaction read from JSON gives that JSON back without encoding it again,
+        # one read from bytes builds it on the first call
+        if self._json is not None:
+            return self._json
+        if self._bytes is not None:
+            self._json = self.encode()
+            return self._json
+        return self.encode()
+
+    def encode(self):
+        # Canonical JSON encoding of the fields, the txid is the hash of it
+        return Transaction.canonical_json(*self.raw_fields())
+
+    @staticmethod
+    def canonical_json(sender, receiver, amount, comment, nonce, signature):
+        # keys and signature are raw bytes, the result is the same as serialize() always produced
+        return CANONICAL_JSON % (json_base64(sender), json_base64(receiver), json_value(nonce),
+                                 json_value(amount), json.dumps(comment), json_base64(signature))
+
+    def raw_fields(self):
+        # (sender, receiver, amount, comment, nonce, signature) with raw key bytes,
+        # read from the bytes or the JSON without building key objects if the fields are not decoded yet
+        if 'sender' in self.__dict__:
+            return (self.sender.to_string(), self.receiver.to_string(), self.amount, self.comment,
+                    self.nonce, self.signature)
+        if self._bytes is not None:
+            _, sender, receiver, signature, amount, nonce, _ = TX_HEADER.unpack_from(self._bytes)
+            return sender, receiver, amount, self._bytes[TX_HEADER.size:].decode('utf-8'), nonce, signature
+        deserialized = json.loads(self._json)
+        return (binascii.a2b_base64(deserialized['sender']), binascii.a2b_base64(deserialized['receiver']),
+                deserialized['amount'], deserialized['comment'], deserialized['nonce'],
+                binascii.a2b_base64(deserialized['signature']))
 
     @classmethod
-    def deserialize(cls, data):
+    def deserialize(cls, data, verify=True):
         # Instantiates/Deserializes object from CBOR or JSON string
-        deserialized = json.loads(data)
-        deserialized['sender'] = deserialized['sender'].encode('ascii')
-        deserialized['receiver'] = deserialized['receiver'].encode('ascii')
-        deserialized['signature'] = deserialized['signature'].encode('ascii')
-        trans = Transaction(ecdsa.VerifyingKey.from_string(base64.decodebytes(deserialized['sender'])),
-                  ecdsa.VerifyingKey.from_string(base64.decodebytes(deserialized['receiver'])),
-                  deserialized['amount'], deserialized['comment'], deserialized['nonce'], base64.decodebytes(deserialized['signature']))
+        # Fields are only decoded from data when first accessed, so the txid and a signature
+        # check that hits verified_signatures cost a single hash of data
+        # verify=False skips the signature check, for transactions already checked in a batch
+        trans = cls.__new__(cls)
+        trans._json = data
+        trans._bytes = None
+        trans._txid = None
+        if not verify:
+            return trans
         try:
             if trans.validate():
                 return trans
@@ -119,6 +175,64 @@ class Transaction:
             print("Oops!", sys.exc_info()[0], "occured.")
             return None
 
+    def to_bytes(self):
+        # Compact binary encoding, raises ValueError for fields it cannot hold
+        # (amounts and nonces that are not integers, other curves, comments over 64KiB)
+        if self._bytes is not None:
+            return self._bytes
+        sender, receiver, amount, comment, nonce, signature = self.raw_fields()
+        comment = comment.encode('utf-8')
+        if len(sender) != KEY_SIZE or len(receiver) != KEY_SIZE or len(signature) != SIGNATURE_SIZE:
+            raise ValueError("binary format only holds NIST192p keys and signatures")
+        if type(amount) is not int or type(nonce) is not int:
+            raise ValueError("binary format only holds integer amounts and nonces")
+        if len(comment) > 0xffff:
+            raise ValueError("comment too long for the binary format")
+        return TX_HEADER.pack(TX_FORMAT_VERSION, sender, receiver, signature, amount, nonce, len(comment)) + comment
+
+    @classmethod
+    def from_bytes(cls, data):
+        # Instantiates a transaction from to_bytes() output. As with deserialize(), the fields are
+        # only decoded when first accessed, and the JSON is only built for serialize() and the txid
+        data = bytes(data)
+        if len(data) < TX_HEADER.size or data[0] != TX_FORMAT_VERSION:
+            raise ValueError("not a version %d binary transaction" % TX_FORMAT_VERSION)
+        comment_length, = struct.unpack_from(">H", data, TX_HEADER.size - 2)
+        if len(data) != TX_HEADER.size + comment_length:
+            raise ValueError("binary transaction has the wrong length")
+        trans = cls.__new__(cls)
+        trans._json = None
+        trans._bytes = data
+        trans._txid = None
+        return trans
+
+    def __getattr__(self, name):
+        # Only called for fields of a transaction read by deserialize() or from_bytes() that are not decoded yet
+        if name in Transaction.FIELDS and (self.__dict__.get('_json') is not None or
+                                           self.__dict__.get('_bytes') is not None):
+            self.decode()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def decode(self):
+        sender, receiver, self.amount, self.comment, self.nonce, self.signature = self.raw_fields()
+        self.receiver = parsed_keys.get(receiver)
+        self.sender = parsed_keys.get(sender)  # set last, raw_fields() reads the JSON or bytes until then
+
+    @property
+    def txid(self):
+        # Hash of the canonical JSON encoding, computed once
+        if self._txid is None:
+            self._txid = MerkleTree.compute_hash(self.serialize())
+        return self._txid
+
+    def is_canonical(self):
+        # Whether the JSON the transaction was read from is its canonical encoding,
+        # only then does the txid of that JSON identify the transaction
+        if self._bytes is not None:
+            return True  # the JSON was built from the bytes
+        return self._json is None or self.encode() == self._json
+
     def sign(self, sk):
         # Sign object with private key passed
         # That can be called within new()
@@ -127,14 +241,29 @@ class Transaction:
 
     def validate(self):
         # Validate transaction correctness ie verify signature
-        # Can be called within from_json()
+        # A signature is verified once, later calls find the txid in verified_signatures
+        if verified_signatures.check(self.txid):
+            return True
+        valid = self.verify_signature()
+        if valid:
+            verified_signatures.add(self.txid)
+        return valid
+
+    def verify_signature(self):
+        # Full check: the JSON must be canonical and the ECDSA signature valid,
+        # raises ecdsa.keys.BadSignatureError on a bad signature
         # vk = self.sender.get_verifying_key()
         # vk.verify(self.signature, data.encode())
+        if not self.is_canonical():
+            return False
         return self.sender.verify(self.signature, self.serialize_sig().encode())
 
     def __eq__(self, other):
         # Check whether transactions are the same
-        return self.signature == other.signature
+        return self.txid == other.txid
+
+    def __hash__(self):
+        return hash(self.txid)
 
 
 